@@ -0,0 +1,385 @@
+"""
+Benchmarks for the busiest routes. Run from the PROJECT directory:
+
+    python bench.py seed --doctors 50 --patients 5000 --appointments 50000
+    python bench.py run --requests 200 --concurrency 4 --save baseline.json
+    python bench.py run --baseline baseline.json          # after a change
+    python bench.py run --url http://127.0.0.1:8000       # against gunicorn/waitress
+
+Both commands open the database named by DATABASE_URL, like the app itself,
+so point it at a scratch database. Seeded accounts use 'bench-password'.
+SQL statements per request can only be counted when the app runs in this
+process (no --url).
+"""
+import http.cookiejar
+import json
+import math
+import random
+import secrets
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from time import perf_counter
+
+import click
+from sqlalchemy import event, insert, select
+
+from main import (
+    create_app, db, User, Doctors, Appointment, DAYS_OF_WEEK,
+    upgrade_schema, ensure_admin, hash_password, import_records, rebuild_stats,
+)
+
+BENCH_DOMAIN = 'bench.local'
+BENCH_PASSWORD = 'bench-password'
+DEPARTMENTS = ('Cardiology', 'Dermatology', 'ENT', 'General', 'Neurology', 'Orthopaedics', 'Paediatrics')
+SYMPTOMS = ('fever', 'cough', 'back pain', 'headache', 'rash', 'checkup', 'follow-up')
+SLOT_TIMES = [f'{hour:02d}:{minute:02d}' for hour in range(9, 17) for minute in (0, 30)]
+APPOINTMENT_CHUNK_SIZE = 5000
+# In-process app; the key only has to outlive one run
+APP_CONFIG = {'OUTBOX_AUTOSTART': False, 'SECRET_KEY': secrets.token_hex(16)}
+
+
+def bench_email(role, number):
+    return f'{role}{number}@{BENCH_DOMAIN}'
+
+
+# --- seeding ---
+
+def seed_accounts(doctors, patients, password_hash):
+    """
+    Loads doctors, patients and Mon-Fri 09:00-17:00 schedules through the
+    bulk import, so stats and audit rows match what the app would write
+    """
+    import_records('doctors', (
+        {'doctorname': f'Doctor {n}', 'email': bench_email('doctor', n),
+         'dept': DEPARTMENTS[n % len(DEPARTMENTS)], 'password_hash': password_hash}
+        for n in range(doctors)
+    ))
+    import_records('patients', (
+        {'username': f'Patient {n}', 'email': bench_email('patient', n), 'password_hash': password_hash}
+        for n in range(patients)
+    ))
+    import_records('schedules', (
+        {'email': bench_email('doctor', n), 'day_name': day,
+         'start_time': '09:00' if day in DAYS_OF_WEEK[:5] else '',
+         'end_time': '17:00' if day in DAYS_OF_WEEK[:5] else ''}
+        for n in range(doctors) for day in DAYS_OF_WEEK
+    ))
+
+
+def seed_appointments(count, rng, past_days=180, future_days=60):
+    """
+    Spreads appointments over weekday slots from past_days ago to future_days
+    ahead without double-booking a doctor. Returns the number written.
+    """
+    doctor_ids = db.session.scalars(
+        select(Doctors.did).where(Doctors.email.like(f'%@{BENCH_DOMAIN}')).order_by(Doctors.did)).all()
+    patient_ids = db.session.scalars(
+        select(User.id).where(User.usertype == 'Patient', User.email.like(f'%@{BENCH_DOMAIN}'))).all()
+    today = date.today()
+    days = [today + timedelta(days=offset) for offset in range(-past_days, future_days)]
+    days = [day for day in days if day.weekday() < 5]
+    slots_per_doctor = len(days) * len(SLOT_TIMES)
+    count = min(count, len(doctor_ids) * slots_per_doctor)
+    if not count or not patient_ids:
+        return 0
+
+    rows = []
+    for index in sorted(rng.sample(range(len(doctor_ids) * slots_per_doctor), count)):
+        doctor_index, slot = divmod(index, slots_per_doctor)
+        day_index, time_index = divmod(slot, len(SLOT_TIMES))
+        day, time = days[day_index], SLOT_TIMES[time_index]
+        if day < today:
+            status = rng.choices(('Completed', 'Cancelled', 'Booked'), (80, 15, 5))[0]
+        else:
+            status = rng.choices(('Booked', 'Cancelled'), (90, 10))[0]
+        rows.append({
+            'doctor_id': doctor_ids[doctor_index], 'patient_id': rng.choice(patient_ids),
+            'date': day.isoformat(), 'time': time, 'status': status,
+            'starts_at': datetime.combine(day, datetime.strptime(time, '%H:%M').time()),
+            'disease': rng.choice(SYMPTOMS),
+        })
+        if len(rows) == APPOINTMENT_CHUNK_SIZE:
+            db.session.execute(insert(Appointment), rows)
+            db.session.commit()
+            rows = []
+    if rows:
+        db.session.execute(insert(Appointment), rows)
+        db.session.commit()
+    return count
+
+
+# --- clients ---
+
+class AppClient:
+    """Drives the app in this process through the Flask test client."""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    """Drives a running server; redirects are not followed, like the test client."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+
+# --- scenarios ---
+
+BenchData = namedtuple('BenchData', 'doctors patients doctor_ids depts')
+Scenario = namedtuple('Scenario', 'role build ok')  # role to log in as, request builder, expected statuses
+
+
+def next_weekday(rng, within_days=60):
+    day = date.today() + timedelta(days=rng.randint(1, within_days))
+    while day.weekday() >= 5:
+        day += timedelta(days=1)
+    return day
+
+
+def login_request(data, rng, worker):
+    return 'POST', '/login', {'email': bench_email('patient', rng.randrange(data.patients)), 'password': BENCH_PASSWORD}
+
+
+def book_request(data, rng, worker):
+    # Taken slots are part of the mix: they exercise the conflict path
+    return 'POST', '/patients', {
+        'doctor_id': rng.choice(data.doctor_ids), 'date': next_weekday(rng).isoformat(),
+        'time': rng.choice(SLOT_TIMES), 'disease': rng.choice(SYMPTOMS),
+    }
+
+
+def free_slots_request(data, rng, worker):
+    start = next_weekday(rng)
+    query = urllib.parse.urlencode({'dept': rng.choice(data.depts), 'start': start.isoformat(),
+                                    'end': (start + timedelta(days=6)).isoformat()})
+    return 'GET', f'/api/free-slots?{query}', None
+
+
+SCENARIOS = {
+    'login': Scenario(None, login_request, {302}),
+    'patient_form': Scenario('patient', lambda data, rng, worker: ('GET', '/patients', None), {200}),
+    'book': Scenario('patient', book_request, {200, 302}),
+    'bookings_patient': Scenario('patient', lambda data, rng, worker: ('GET', '/bookings', None), {200}),
+    'bookings_doctor': Scenario('doctor', lambda data, rng, worker: ('GET', '/bookings', None), {200}),
+    'free_slots': Scenario('patient', free_slots_request, {200}),
+    'admin_dashboard': Scenario('admin', lambda data, rng, worker: ('GET', '/admin/dashboard', None), {200}),
+}
+
+
+# --- running and reporting ---
+
+_statements = threading.local()
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    _statements.count = getattr(_statements, 'count', 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def log_in(client, role, worker, data, admin_email, admin_password):
+    if role == 'admin':
+        form = {'email': admin_email, 'password': admin_password}
+    elif role == 'doctor':
+        form = {'email': bench_email('doctor', worker % data.doctors), 'password': BENCH_PASSWORD}
+    else:
+        form = {'email': bench_email('patient', worker % data.patients), 'password': BENCH_PASSWORD}
+    if client.request('POST', '/login', form) != 302:
+        raise click.ClickException(f"Could not log in as {form['email']}")
+
+
+def run_scenario(name, make_client, data, requests, concurrency, warmup, seed, credentials):
+    """
+    Splits requests over concurrency worker threads, each with its own client
+    and session. Returns a result dict for the report.
+    """
+    scenario = SCENARIOS[name]
+    samples, lock = [], threading.Lock()
+
+    def worker(number):
+        rng = random.Random(f'{seed}:{name}:{number}')
+        client = make_client()
+        if scenario.role:
+            log_in(client, scenario.role, number, data, *credentials)
+        own = []
+        share = requests // concurrency + (number < requests % concurrency)
+        for index in range(warmup + share):
+            method, path, form = scenario.build(data, rng, number)
+            _statements.count = 0
+            started = perf_counter()
+            status = client.request(method, path, form)
+            elapsed = perf_counter() - started
+            if index >= warmup:
+                own.append((elapsed, status, _statements.count))
+        with lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, status, statements in samples)
+    statements = [statements for elapsed, status, statements in samples]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for elapsed, status, count in samples if status not in scenario.ok),
+        'throughput': len(samples) / wall if wall else 0.0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'sql_per_request': sum(statements) / len(statements) if statements else 0.0,
+        'sql_max': max(statements, default=0),
+    }
+
+
+def print_report(results, baseline=None, count_sql=True):
+    print(f"{'scenario':<18}{'reqs':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/req':>9}")
+    for name, result in results.items():
+        sql = f"{result['sql_per_request']:>9.1f}" if count_sql else f"{'-':>9}"
+        line = (f"{name:<18}{result['requests']:>6}{result['errors']:>8}{result['throughput']:>9.1f}"
+                f"{result['p50']:>9.1f}{result['p95']:>9.1f}{result['p99']:>9.1f}{sql}")
+        if baseline and name in baseline:
+            line += f"   p95 {result['p95'] - baseline[name]['p95']:+.1f} ms"
+            if count_sql:
+                line += f", sql {result['sql_per_request'] - baseline[name]['sql_per_request']:+.1f}"
+        print(line)
+
+
+def find_regressions(results, baseline, tolerance, count_sql=True):
+    """
+    A scenario regresses when it starts failing, when p95 grows by more than
+    tolerance, or when it needs more SQL statements than before
+    """
+    problems = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if result['errors'] > before['errors']:
+            problems.append(f"{name}: {result['errors']} errors (was {before['errors']})")
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            problems.append(f"{name}: p95 {result['p95']:.1f} ms (was {before['p95']:.1f} ms)")
+        if count_sql and result['sql_per_request'] > before['sql_per_request'] + 0.5:
+            problems.append(f"{name}: {result['sql_per_request']:.1f} SQL statements per request "
+                            f"(was {before['sql_per_request']:.1f})")
+    return problems
+
+
+# --- commands ---
+
+@click.group()
+def cli():
+    """Seed benchmark data and measure route latency."""
+
+
+@cli.command()
+@click.option('--doctors', default=50, show_default=True)
+@click.option('--patients', default=2000, show_default=True)
+@click.option('--appointments', default=20000, show_default=True)
+@click.option('--seed', default=1, show_default=True, help='Random seed, for reproducible data.')
+def seed(doctors, patients, appointments, seed):
+    """Fill the database with benchmark doctors, patients and appointments."""
+    app = create_app(APP_CONFIG)
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        ensure_admin()
+        if db.session.scalar(select(User.id).where(User.email == bench_email('patient', 0))):
+            raise click.ClickException("This database already has benchmark data; use a fresh DATABASE_URL.")
+
+        started = perf_counter()
+        # Everyone shares one hash: hashing is measured by the login scenario, not here
+        seed_accounts(doctors, patients, hash_password(BENCH_PASSWORD))
+        written = seed_appointments(appointments, random.Random(seed))
+        rebuild_stats()
+        print(f"Seeded {doctors} doctors, {patients} patients and {written} appointments "
+              f"in {perf_counter() - started:.1f}s")
+
+
+@cli.command()
+@click.option('--requests', 'requests_per_scenario', default=200, show_default=True, help='Timed requests per scenario.')
+@click.option('--concurrency', default=4, show_default=True, help='Worker threads per scenario.')
+@click.option('--warmup', default=3, show_default=True, help='Untimed requests per worker before measuring.')
+@click.option('--scenario', 'names', multiple=True, type=click.Choice(list(SCENARIOS)), help='Repeatable; default all.')
+@click.option('--url', help='Benchmark a running server instead of the app in this process.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--admin-email', default='admin@rammidoc.local', show_default=True)
+@click.option('--admin-password', default='Admin@123')
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results as JSON.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare with saved results.')
+@click.option('--tolerance', default=0.25, show_default=True, help='Allowed p95 growth against the baseline.')
+def run(requests_per_scenario, concurrency, warmup, names, url, seed, admin_email, admin_password,
+        save, baseline, tolerance):
+    """Run the scenarios and report latency, throughput and SQL per request."""
+    app = create_app(APP_CONFIG)
+    with app.app_context():
+        doctor_ids = db.session.scalars(
+            select(Doctors.did).where(Doctors.email.like(f'%@{BENCH_DOMAIN}')).order_by(Doctors.did)).all()
+        patients = db.session.scalar(
+            select(db.func.count()).where(User.usertype == 'Patient', User.email.like(f'%@{BENCH_DOMAIN}')))
+        depts = db.session.scalars(select(Doctors.dept).where(Doctors.did.in_(doctor_ids)).distinct()).all()
+        if not doctor_ids or not patients:
+            raise click.ClickException("No benchmark data found; run 'python bench.py seed' first.")
+        if not url:
+            event.listen(db.engine, 'before_cursor_execute', count_statement)
+    data = BenchData(len(doctor_ids), patients, doctor_ids, depts)
+
+    make_client = (lambda: HttpClient(url)) if url else (lambda: AppClient(app))
+    results = {}
+    for name in names or SCENARIOS:
+        results[name] = run_scenario(name, make_client, data, requests_per_scenario, concurrency, warmup, seed,
+                                     (admin_email, admin_password))
+
+    previous = None
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+    print_report(results, previous, count_sql=not url)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if previous:
+        problems = find_regressions(results, previous, tolerance, count_sql=not url)
+        for problem in problems:
+            print('REGRESSION', problem)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
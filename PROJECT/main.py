@@ -1,12 +1,36 @@
 # --- Standard Python Library ---
+import base64
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
 import json
-from datetime import datetime, time
+import mimetypes
+import os
+import random
+import re
+import secrets
+import shutil
+import smtplib
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
 from functools import wraps
+from time import monotonic, perf_counter
 
 # --- Core Flask ---
 from flask import (
-    Flask, render_template, request, 
-    session, redirect, url_for, flash
+    Flask, Blueprint, render_template, request, 
+    session, redirect, url_for, flash, jsonify, g, current_app,
+    has_request_context, Response, stream_with_context, abort, send_from_directory,
+    before_render_template, template_rendered
 )
 
 # --- Flask Extensions ---
@@ -15,46 +39,183 @@ from flask_login import (
     UserMixin, login_user, logout_user, 
     LoginManager, login_required, current_user
 )
-from flask_mail import Mail
+from flask_mail import Mail, Message
 
 # --- Other Third-Party Libraries ---
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import or_
+import click
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import (
+    or_, tuple_, event, inspect, text, insert, update, select, bindparam, literal, union_all, MetaData, Table
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload, lazyload, selectinload
+
+# --- Optional: used by 'flask build-assets' when installed ---
+try:
+    from PIL import Image  # resizing and WebP variants
+except ImportError:
+    Image = None
+try:
+    import brotli  # .br copies of CSS and JS
+except ImportError:
+    brotli = None
+
+
+# --- RAMMIDOC: configuration ---
+# These defaults suit local development. Any of them can be overridden with
+# an environment variable of the same name (DATABASE_URL sets the database),
+# or by passing a dict to create_app().
+# Signs session cookies. Published with the code, so create_app() refuses it
+# outside debug and testing.
+DEVELOPMENT_SECRET_KEY = 'mayank'
+DEFAULT_CONFIG = dict(
+    SECRET_KEY=DEVELOPMENT_SECRET_KEY,
+    SQLALCHEMY_DATABASE_URI='sqlite:///rammidoc.db',
+
+    # Connection pool, used for server databases such as PostgreSQL
+    DB_POOL_SIZE=10,
+    DB_MAX_OVERFLOW=20,
+    DB_POOL_RECYCLE=1800,  # seconds
+    # How long a SQLite writer waits for a lock before giving up
+    SQLITE_BUSY_TIMEOUT=5000,  # milliseconds
+
+    # SMTP MAIL SERVER SETTINGS
+    MAIL_SERVER='smtp.gmail.com',
+    MAIL_PORT=465,
+    MAIL_USE_SSL=True,
+    MAIL_USERNAME=" gmail-id",
+    MAIL_PASSWORD=" gmail-password",
+    MAIL_DEFAULT_SENDER="noreply@rammidoc.local",
+    # Notifications are queued in the outbox table and sent by a background
+    # thread; set this to False when a separate 'flask outbox-worker' runs
+    OUTBOX_AUTOSTART=True,
+
+    # PASSWORD HASHING AND LOGIN THROTTLING
+    # Any werkzeug method string, e.g. 'scrypt:16384:8:1' or 'pbkdf2:sha256:600000'.
+    # Stored hashes using other parameters are upgraded when their owner logs in.
+    PASSWORD_HASH_METHOD='scrypt:32768:8:1',
+    LOGIN_MAX_FAILURES_PER_EMAIL=5,
+    LOGIN_MAX_FAILURES_PER_IP=20,
+    LOGIN_FAILURE_WINDOW=900,  # seconds
+    # Reverse proxies in front of the app. Client IPs (for the login throttle)
+    # are then read from X-Forwarded-For; leave at 0 when clients connect directly.
+    PROXY_COUNT=0,
+
+    # 'flask build-assets' scales wider images down to this many pixels
+    ASSET_IMAGE_MAX_WIDTH=1600,
+
+    # ARCHIVE ('flask archive'), SQLite only. The archive file is attached to
+    # every connection. Empty means '<database name>-archive.db' next to the
+    # main database (off for in-memory databases), a relative path is inside
+    # the instance folder, and 'off' turns archiving off.
+    ARCHIVE_DATABASE='',
+    ARCHIVE_AFTER_DAYS=365,  # completed and cancelled visits older than this move out
+
+    # How long shared caches may reuse /api/v1 doctor and schedule responses
+    API_MAX_AGE=60,  # seconds
+
+    # REQUEST INSTRUMENTATION (see /admin/metrics)
+    METRICS_ENABLED=False,
+    METRICS_TOKEN='',             # lets a scraper send 'Authorization: Bearer <token>' instead of logging in
+    METRICS_SLOW_STATEMENTS=5,    # slowest SQL statements kept per endpoint
+    PROFILE_SAMPLE_RATE=0.0,      # fraction of requests to run under cProfile
+    PROFILE_DIR='profiles'        # relative to the instance folder
+)
 
 
-local_server= True
-app = Flask(__name__)
-app.secret_key='mayank'
+def load_config(overrides=None):
+    """
+    DEFAULT_CONFIG with environment overrides (converted to the default's type)
+    and then the given overrides applied
+    """
+    config = {}
+    for key, default in DEFAULT_CONFIG.items():
+        raw = os.environ.get(key)
+        if raw is None:
+            config[key] = default
+        elif isinstance(default, bool):
+            config[key] = raw.lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(default, int):
+            config[key] = int(raw)
+        elif isinstance(default, float):
+            config[key] = float(raw)
+        else:
+            config[key] = raw
+    if os.environ.get('DATABASE_URL'):
+        config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+    config.update(overrides or {})
+
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if uri.startswith('postgres://'):
+        # Some hosts still hand out the old scheme name
+        config['SQLALCHEMY_DATABASE_URI'] = uri = 'postgresql://' + uri[len('postgres://'):]
+    if 'SQLALCHEMY_ENGINE_OPTIONS' not in config:
+        if uri.startswith('sqlite'):
+            config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+                'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000},
+            }
+        else:
+            config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+                'pool_size': config['DB_POOL_SIZE'],
+                'max_overflow': config['DB_MAX_OVERFLOW'],
+                'pool_recycle': config['DB_POOL_RECYCLE'],
+                'pool_pre_ping': True,
+            }
+    return config
 
 
-# this is for getting unique user access
-login_manager=LoginManager(app)
-login_manager.login_view='login'
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers keep going while a booking is being written, and
+    synchronous=NORMAL is safe with WAL while saving an fsync per commit.
+    The busy timeout itself comes from the 'timeout' connect argument.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
 
-# SMTP MAIL SERVER SETTINGS
 
-app.config.update(
-    MAIL_SERVER='smtp.gmail.com',
-    MAIL_PORT='465',
-    MAIL_USE_SSL=True,
-    MAIL_USERNAME=" gmail-id",
-    MAIL_PASSWORD=" gmail-password"
-)
-mail = Mail(app)
+# Extensions are bound to the app in create_app()
+db = SQLAlchemy()
+mail = Mail()
+
+# this is for getting unique user access
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+
+# All routes and CLI commands live on this blueprint
+main = Blueprint('main', __name__, cli_group=None)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
+    # Served from the per-process identity cache; see IdentityCache
+    return identity_cache.get(int(user_id))
 
 
+def get_current_doctor():
+    """
+    The logged-in doctor's roster entry (did, email, doctorname, dept), or None.
+    The doctor id comes with the cached identity, the rest from the schedule cache.
+    """
+    if 'current_doctor' not in g:
+        g.current_doctor = None
+        if current_user.is_authenticated and current_user.usertype == 'Doctor':
+            doctor_id = getattr(current_user, 'doctor_id', None)
+            if doctor_id is None:
+                # A freshly logged-in ORM User, not yet cached
+                doctor_id = db.session.scalar(select(Doctors.did).where(Doctors.email == current_user.email).limit(1))
+            g.current_doctor = schedule_cache.get_doctor(doctor_id) if doctor_id else None
+    return g.current_doctor
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///rammidoc.db'
-db=SQLAlchemy(app)
 
 
-# ... after db=SQLAlchemy(app) ...
 
 class Test(db.Model):
     id=db.Column(db.Integer,primary_key=True)
@@ -70,7 +231,8 @@ class User(UserMixin,db.Model):
     password=db.Column(db.String(1000))
     
     # Add relationship: A User (Patient) can have many appointments
-    appointments = db.relationship('Appointment', back_populates='patient', foreign_keys='Appointment.patient_id')
+    # (can be large; views query appointments directly instead of using this)
+    appointments = db.relationship('Appointment', back_populates='patient', foreign_keys='Appointment.patient_id', lazy='select')
 
 class Doctors(db.Model):
     did=db.Column(db.Integer,primary_key=True)
@@ -79,45 +241,108 @@ class Doctors(db.Model):
     dept=db.Column(db.String(50))
     
     # Add relationship: A Doctor can have many appointments
-    appointments = db.relationship('Appointment', back_populates='doctor', foreign_keys='Appointment.doctor_id')
-    # Add relationship: A Doctor can have many availability entries
-    availability_schedule = db.relationship('DoctorAvailability', back_populates='doctor', cascade="all, delete-orphan")
+    # (can be large; views query appointments directly instead of using this)
+    appointments = db.relationship('Appointment', back_populates='doctor', foreign_keys='Appointment.doctor_id', lazy='select')
+    # Add relationship: A Doctor can have many availability entries (7 rows, load them in one IN query)
+    availability_schedule = db.relationship('DoctorAvailability', back_populates='doctor', cascade="all, delete-orphan", lazy='selectin')
 
 
 # NEW: This is your old 'Patients' model, renamed and fixed
 class Appointment(db.Model):
+    __table_args__ = (
+        # Slot conflict checks look up (doctor_id, date, time)
+        db.Index('ix_appointment_doctor_slot', 'doctor_id', 'date', 'time'),
+        # Keyset pages of one patient's history
+        db.Index('ix_appointment_patient_timeline', 'patient_id', 'date', 'time', 'id'),
+        # Free slots and department load read a doctor's bookings over a time range
+        db.Index('ix_appointment_doctor_starts_at', 'doctor_id', 'starts_at'),
+        # A doctor can only have one live appointment per slot. Cancelled rows
+        # are left out so their slot can be booked again.
+        db.Index(
+            'uq_appointment_active_slot', 'doctor_id', 'date', 'time',
+            unique=True,
+            sqlite_where=text("status != 'Cancelled'"),
+            postgresql_where=text("status != 'Cancelled'")
+        ),
+        # Archived ids must never be handed out again (see archive_appointments)
+        {'sqlite_autoincrement': True},
+    )
+
     id=db.Column(db.Integer,primary_key=True)
     time=db.Column(db.String(50),nullable=False)
     date=db.Column(db.String(50),nullable=False)
     disease=db.Column(db.String(50)) # Kept from your old model
+    # Typed copy of date + time, kept in sync by sync_appointment_starts_at().
+    # NULL for legacy rows whose date or time does not parse.
+    starts_at=db.Column(db.DateTime)
     
     # --- NEW REQUIRED FIELDS ---
-    status=db.Column(db.String(50), default='Booked') # "Booked", "Completed", "Cancelled"
+    status=db.Column(db.String(50), default='Booked', index=True) # "Booked", "Completed", "Cancelled"
     
     # --- NEW FOREIGN KEYS ---
-    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.did'), nullable=False)
     
     # --- NEW RELATIONSHIPS ---
     # Links this Appointment to the User who is the patient
-    patient = db.relationship('User', back_populates='appointments', foreign_keys=[patient_id])
+    # Loaded on access; list views join both in with with_people()
+    patient = db.relationship('User', back_populates='appointments', foreign_keys=[patient_id], lazy='select')
     # Links this Appointment to the Doctor
-    doctor = db.relationship('Doctors', back_populates='appointments', foreign_keys=[doctor_id])
+    doctor = db.relationship('Doctors', back_populates='appointments', foreign_keys=[doctor_id], lazy='select')
     # Links this Appointment to its treatment record
-    treatment = db.relationship('Treatment', back_populates='appointment', uselist=False) # one-to-one
+    # Only treatment views need it; lists add selectinload() when they do
+    treatment = db.relationship('Treatment', back_populates='appointment', uselist=False, lazy='select') # one-to-one
+
+def parse_slot(date_str, time_str):
+    """
+    Combines the 'YYYY-MM-DD' and 'HH:MM' form values into a datetime.
+    Returns None if either value is malformed.
+    """
+    try:
+        return datetime.strptime(f"{date_str} {time_str}", '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+
+
+def is_slot_conflict(error):
+    """
+    True if an IntegrityError came from uq_appointment_active_slot
+    """
+    message = str(error.orig)
+    return 'uq_appointment_active_slot' in message or 'appointment.doctor_id, appointment.date, appointment.time' in message
+
+
+@event.listens_for(Appointment, 'before_insert')
+@event.listens_for(Appointment, 'before_update')
+def sync_appointment_starts_at(mapper, connection, target):
+    target.starts_at = parse_slot(target.date, target.time)
+
+
+def with_people(model=None):
+    """
+    Query options that join the patient and doctor of each row into the same
+    SELECT, for lists that show them. Relationships are lazy by default so
+    other loads (stats, exports, the archive) do not pay for the joins; the
+    doctors' weekly schedules are not needed for a list and are skipped.
+    """
+    model = model or Appointment
+    return [joinedload(model.patient), joinedload(model.doctor).lazyload(Doctors.availability_schedule)]
+
 
 # NEW: Model for Treatment/History
 class Treatment(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id=db.Column(db.Integer, primary_key=True)
     diagnosis=db.Column(db.Text, nullable=True)
     prescription=db.Column(db.Text, nullable=True)
     notes=db.Column(db.Text, nullable=True)
     
     # --- NEW FOREIGN KEY ---
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False, index=True)
     
     # --- NEW RELATIONSHIP ---
-    appointment = db.relationship('Appointment', back_populates='treatment')
+    appointment = db.relationship('Appointment', back_populates='treatment', lazy='select')
 
 
 class DoctorAvailability(db.Model):
@@ -127,27 +352,897 @@ class DoctorAvailability(db.Model):
     end_time = db.Column(db.String(5), nullable=True)   # e.g., "17:00"
     
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.did'), nullable=False)
-    doctor = db.relationship('Doctors', back_populates='availability_schedule')
+    doctor = db.relationship('Doctors', back_populates='availability_schedule', lazy='select')
 
 
-# We can keep Trigr, but it should be updated to watch the 'Appointment' table
-class Trigr(db.Model):
-    tid=db.Column(db.Integer,primary_key=True)
-    pid=db.Column(db.Integer)
-    email=db.Column(db.String(50))
-    name=db.Column(db.String(50))
-    action=db.Column(db.String(50))
-    timestamp=db.Column(db.String(50))
+DAYS_OF_WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+# Date-specific exceptions to the weekly schedule (holidays, one-off clinics).
+# Empty start/end times mean the doctor is off that day.
+class AvailabilityOverride(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'date', name='uq_override_doctor_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.String(10), nullable=False)   # e.g., "2025-12-25"
+    start_time = db.Column(db.String(5), nullable=True)
+    end_time = db.Column(db.String(5), nullable=True)
+    reason = db.Column(db.String(100))
+
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.did'), nullable=False)
+
+
+
+# --- RAMMIDOC: process-local cache for doctor schedules and the roster ---
+# Schedules only change when a doctor saves /doctor/availability or an admin
+# edits the doctor list, so the booking form reads them from here instead of
+# the database. Those routes call schedule_cache.invalidate(); the TTL is a
+# safety net for changes made by another worker process.
+SCHEDULE_CACHE_TTL = 300  # seconds
+
+# Plain snapshots, so cached values never touch a closed session
+DoctorInfo = namedtuple('DoctorInfo', ['did', 'email', 'doctorname', 'dept'])
+
+
+class ScheduleCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0        # bumped by invalidate(), lets derived caches notice
+        self._lock = threading.Lock()
+        self._roster = None        # (expires_at, [DoctorInfo, ...])
+        self._schedules = {}       # doctor_id -> (expires_at, ({day_name: (start, end)}, {date: (start, end)}))
+
+    def _fresh(self, entry):
+        if entry and entry[0] > monotonic():
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def get_roster(self):
+        with self._lock:
+            entry = self._roster
+            if self._fresh(entry):
+                return entry[1]
+        roster = [DoctorInfo(d.did, d.email, d.doctorname, d.dept) for d in Doctors.query.order_by(Doctors.did).all()]
+        with self._lock:
+            self._roster = (monotonic() + self.ttl, roster)
+        return roster
+
+    def get_doctor(self, doctor_id):
+        for doctor in self.get_roster():
+            if doctor.did == doctor_id:
+                return doctor
+        return None
+
+    def _load(self, doctor_id):
+        with self._lock:
+            entry = self._schedules.get(doctor_id)
+            if self._fresh(entry):
+                return entry[1]
+        weekly = {
+            row.day_name: (row.start_time, row.end_time)
+            for row in DoctorAvailability.query.filter_by(doctor_id=doctor_id).all()
+        }
+        overrides = {
+            row.date: (row.start_time, row.end_time)
+            for row in AvailabilityOverride.query.filter_by(doctor_id=doctor_id).all()
+        }
+        with self._lock:
+            self._schedules[doctor_id] = (monotonic() + self.ttl, (weekly, overrides))
+        return weekly, overrides
+
+    def preload(self, doctor_ids):
+        """
+        Loads every missing or expired schedule among doctor_ids with one
+        query per table, so a department-wide lookup never goes doctor by doctor
+        """
+        with self._lock:
+            now = monotonic()
+            missing = [did for did in doctor_ids
+                       if not (did in self._schedules and self._schedules[did][0] > now)]
+        if not missing:
+            return
+        self.misses += len(missing)
+        loaded = {did: ({}, {}) for did in missing}
+        for row in DoctorAvailability.query.filter(DoctorAvailability.doctor_id.in_(missing)).all():
+            loaded[row.doctor_id][0][row.day_name] = (row.start_time, row.end_time)
+        for row in AvailabilityOverride.query.filter(AvailabilityOverride.doctor_id.in_(missing)).all():
+            loaded[row.doctor_id][1][row.date] = (row.start_time, row.end_time)
+        with self._lock:
+            expires_at = monotonic() + self.ttl
+            for did, schedule in loaded.items():
+                self._schedules[did] = (expires_at, schedule)
+
+    def get_schedule(self, doctor_id):
+        """
+        Returns {day_name: (start_time, end_time)} for one doctor
+        """
+        return self._load(doctor_id)[0]
+
+    def get_hours(self, doctor_id, day):
+        """
+        Working hours on a given date, with any date override applied.
+        Returns (None, None) when the doctor is off.
+        """
+        weekly, overrides = self._load(doctor_id)
+        if day.isoformat() in overrides:
+            return overrides[day.isoformat()]
+        return weekly.get(day.strftime('%A'), (None, None))
+
+    def invalidate(self, doctor_id=None):
+        """
+        Drops one doctor's schedule, or everything when no doctor is given
+        """
+        with self._lock:
+            self.generation += 1
+            if doctor_id is None:
+                self._roster = None
+                self._schedules.clear()
+            else:
+                self._schedules.pop(doctor_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._schedules)}
+
+
+schedule_cache = ScheduleCache(SCHEDULE_CACHE_TTL)
+
+
+# --- RAMMIDOC: identity cache ---
+# Flask-Login reloads the user on every request. The fields requests read
+# (plus the doctor id) are kept in a per-process LRU instead. Commits that
+# touch a user or a doctor profile drop the affected entries; the TTL bounds
+# how long other worker processes can serve an identity changed elsewhere.
+IDENTITY_CACHE_SIZE = 2048
+IDENTITY_CACHE_TTL = 60  # seconds
+
+
+class CachedUser(UserMixin):
+    """
+    Read-only stand-in for User as current_user. Load the User row to change it.
+    """
+    def __init__(self, id, username, usertype, email, doctor_id):
+        self.id = id
+        self.username = username
+        self.usertype = usertype
+        self.email = email
+        self.doctor_id = doctor_id
+
+
+class IdentityCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user id -> (expires_at, CachedUser), least recent first
+        # Bumped by every invalidation. A load that started before one is not
+        # stored, so a slow query cannot put back data that was just dropped.
+        self._version = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            version = self._version
+
+        row = db.session.execute(
+            select(User.id, User.username, User.usertype, User.email, Doctors.did)
+            .outerjoin(Doctors, (Doctors.email == User.email) & (User.usertype == 'Doctor'))
+            .where(User.id == user_id).limit(1)
+        ).first()
+        if row is None:
+            return None
+        user = CachedUser(*row)
+
+        with self._lock:
+            if version == self._version:
+                self._entries[user_id] = (monotonic() + self.ttl, user)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_ids=None):
+        """
+        Drops the given user ids, or everything when user_ids is None
+        """
+        with self._lock:
+            self._version += 1
+            if user_ids is None:
+                self._entries.clear()
+            else:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_identity_changes(session, flush_context):
+    changed = session.info.setdefault('identity_changed', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Doctors):
+            # Email links users to profiles; rare enough to drop everything
+            changed.add(None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_identities(session):
+    changed = session.info.pop('identity_changed', None)
+    if changed:
+        identity_cache.invalidate(None if None in changed else changed)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_identity_changes(session):
+    session.info.pop('identity_changed', None)
+
+
+# --- RAMMIDOC: incrementally maintained statistics ---
+# Counters live in stat_counter as (scope, key) -> value, for example
+# ('status', 'Booked') or ('day', '2025-11-15'). A before_flush hook turns
+# every booking, cancellation, completion, signup and deletion into counter
+# deltas inside the same transaction, so they can never drift from a rolled
+# back write. 'flask rebuild-stats' recomputes everything from scratch.
+STATS_CACHE_TTL = 30  # seconds, covers writes made by other processes
+
+
+class StatCounter(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_stat_counter_scope_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)  # 'total', 'status', 'dept', 'doctor', 'day'
+    key = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+_stats_cache = {'expires_at': 0, 'value': None}
+
+
+def _history(obj, attr):
+    """
+    Returns (old, new) for an attribute changed in this flush, or None
+    """
+    hist = inspect(obj).attrs[attr].history
+    if not hist.has_changes():
+        return None
+    old = hist.deleted[0] if hist.deleted else None
+    new = hist.added[0] if hist.added else None
+    return old, new
+
+
+def _appointment_keys(doctor_id, status, date_str):
+    # The 'dept' counter is derived from 'doctor' in apply_stat_deltas
+    return [('total', 'appointments'), ('status', status or 'Booked'),
+            ('doctor', str(int(doctor_id))), ('day', date_str)]
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_stat_deltas(session, flush_context, instances):
+    deltas = {}
+
+    def bump(keys, amount):
+        for key in keys:
+            deltas[key] = deltas.get(key, 0) + amount
+
+    # New appointments are counted in count_new_appointments, once a doctor
+    # set through the relationship has given them a doctor_id
+    for obj in session.new:
+        if isinstance(obj, User) and obj.usertype == 'Patient':
+            bump([('total', 'patients')], 1)
+        elif isinstance(obj, Doctors):
+            bump([('total', 'doctors')], 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Appointment):
+            status, date, doctor = (_history(obj, a) for a in ('status', 'date', 'doctor_id'))
+            if status or date or doctor:
+                old = _appointment_keys(doctor[0] if doctor else obj.doctor_id,
+                                        status[0] if status else obj.status,
+                                        date[0] if date else obj.date)
+                bump(old, -1)
+                bump(_appointment_keys(obj.doctor_id, obj.status, obj.date), 1)
+        elif isinstance(obj, User):
+            usertype = _history(obj, 'usertype')
+            if usertype and 'Patient' in usertype:
+                bump([('total', 'patients')], 1 if usertype[1] == 'Patient' else -1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Appointment):
+            bump(_appointment_keys(obj.doctor_id, obj.status, obj.date), -1)
+        elif isinstance(obj, User) and obj.usertype == 'Patient':
+            bump([('total', 'patients')], -1)
+        elif isinstance(obj, Doctors):
+            bump([('total', 'doctors')], -1)
+
+    apply_stat_deltas(session, deltas)
+
+    # A doctor moved to another department takes their appointment count along.
+    # The old department is read from the row: history lacks it when the
+    # attribute was expired before being set.
+    for obj in session.dirty:
+        if isinstance(obj, Doctors) and obj.did is not None and _history(obj, 'dept'):
+            connection = session.connection()
+            old_dept = connection.scalar(select(Doctors.dept).where(Doctors.did == obj.did)) or ''
+            if old_dept != (obj.dept or ''):
+                count = connection.scalar(select(StatCounter.value).where(
+                    StatCounter.scope == 'doctor', StatCounter.key == str(obj.did))) or 0
+                apply_stat_deltas(session, {('dept', old_dept): -count, ('dept', obj.dept or ''): count})
+
+
+@event.listens_for(db.session, 'after_flush')
+def count_new_appointments(session, flush_context):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Appointment):
+            for key in _appointment_keys(obj.doctor_id, obj.status, obj.date):
+                deltas[key] = deltas.get(key, 0) + 1
+    apply_stat_deltas(session, deltas)
+
+
+def apply_stat_deltas(session, deltas):
+    """
+    Adds {(scope, key): delta} to the counters in the session's transaction.
+    Bulk writes that skip ORM events call this themselves.
+    """
+    # Department counters follow the doctor counters. Resolved with one Core
+    # query on the flush's own connection, so no ORM loading happens mid-flush.
+    by_doctor = {int(key): delta for (scope, key), delta in deltas.items() if scope == 'doctor' and delta}
+    if by_doctor:
+        deltas = dict(deltas)
+        for did, dept in session.connection().execute(
+                select(Doctors.did, Doctors.dept).where(Doctors.did.in_(list(by_doctor)))):
+            deltas[('dept', dept or '')] = deltas.get(('dept', dept or ''), 0) + by_doctor[did]
+
+    # Net changes only; 'Booked' -> 'Booked' style edits cancel out
+    params = [{'scope': scope, 'key': key, 'delta': delta}
+              for (scope, key), delta in deltas.items() if delta]
+    if params:
+        session.connection().execute(text(
+            """INSERT INTO stat_counter (scope, key, value) VALUES (:scope, :key, :delta)
+               ON CONFLICT (scope, key) DO UPDATE SET value = stat_counter.value + excluded.value"""
+        ), params)
+        session.info['stats_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def expire_stats_cache(session):
+    if session.info.pop('stats_changed', False):
+        _stats_cache['expires_at'] = 0
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_stat_deltas(session):
+    session.info.pop('stats_changed', None)
+
+
+def rebuild_stats():
+    """
+    Recomputes every counter from the source tables in one transaction
+    """
+    date_col = Appointment.date
+    status_col = db.func.coalesce(Appointment.status, 'Booked')
+    grouped = {
+        'status': db.session.query(status_col, db.func.count()).group_by(status_col),
+        'doctor': db.session.query(Appointment.doctor_id, db.func.count()).group_by(Appointment.doctor_id),
+        'day': db.session.query(date_col, db.func.count()).group_by(date_col),
+        'dept': db.session.query(Doctors.dept, db.func.count(Appointment.id)).join(
+            Appointment, Appointment.doctor_id == Doctors.did).group_by(Doctors.dept),
+    }
+    rows = [
+        {'scope': 'total', 'key': 'appointments', 'value': Appointment.query.count()},
+        {'scope': 'total', 'key': 'patients', 'value': User.query.filter_by(usertype='Patient').count()},
+        {'scope': 'total', 'key': 'doctors', 'value': Doctors.query.count()},
+    ]
+    for scope, query in grouped.items():
+        rows += [{'scope': scope, 'key': str(key or ''), 'value': count} for key, count in query.all()]
+
+    db.session.query(StatCounter).delete()
+    db.session.execute(insert(StatCounter), rows)
+    db.session.commit()
+    _stats_cache['expires_at'] = 0
+    return len(rows)
+
+
+def get_stats():
+    """
+    Returns {'doctors': n, 'patients': n, 'appointments': n,
+             'by_status': {...}, 'by_dept': {...}, 'by_doctor': {...}, 'by_day': {...}}
+    from memory, reading the small stat_counter table only when the cache has expired
+    """
+    if _stats_cache['value'] is not None and _stats_cache['expires_at'] > monotonic():
+        return _stats_cache['value']
+
+    stats = {'doctors': 0, 'patients': 0, 'appointments': 0,
+             'by_status': {}, 'by_dept': {}, 'by_doctor': {}, 'by_day': {}}
+    for counter in StatCounter.query.all():
+        if counter.scope == 'total':
+            stats[counter.key] = counter.value
+        elif counter.value:
+            stats[f'by_{counter.scope}'][counter.key] = counter.value
+
+    _stats_cache['value'] = stats
+    _stats_cache['expires_at'] = monotonic() + STATS_CACHE_TTL
+    return stats
+
+
+@main.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard statistics from scratch."""
+    count = rebuild_stats()
+    print(f'[RAMMIDOC] Rebuilt {count} statistics counters')
+
+
+# --- RAMMIDOC: outbound email queue ---
+# Routes never talk to SMTP. They add an OutboxMessage in the same
+# transaction as the booking change, and a background worker delivers due
+# messages in batches over one SMTP connection, retrying failures with
+# exponential backoff. To try it locally, point MAIL_SERVER/MAIL_PORT at a
+# debugging server such as 'python -m smtpd -n -c DebuggingServer localhost:1025'
+# with MAIL_USE_SSL=False.
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_SECONDS = 30
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+class OutboxMessage(db.Model):
+    __table_args__ = (
+        db.Index('ix_outbox_due', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))                 # 'booked', 'rescheduled', 'cancelled', 'completed'
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')  # 'pending', 'sending', 'sent', 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    claimed_at = db.Column(db.DateTime)
+    claim_token = db.Column(db.String(32))  # set by the worker that is sending it
+
+
+NOTIFICATIONS = {
+    'booked': ("Appointment confirmed",
+               "Your appointment with Dr. {doctor} on {date} at {time} is confirmed."),
+    'rescheduled': ("Appointment rescheduled",
+                    "Your appointment with Dr. {doctor} has been moved to {date} at {time}."),
+    'cancelled': ("Appointment cancelled",
+                  "Your appointment with Dr. {doctor} on {date} at {time} has been cancelled."),
+    'waitlist': ("Waitlist slot booked",
+                 "A slot opened up with Dr. {doctor} on {date} at {time} and has been booked for you "
+                 "from the waitlist. If you cannot make it, please cancel it under My Bookings "
+                 "so the next patient can have it."),
+    'recurring': ("Appointments confirmed",
+                  "Your {count} appointments with Dr. {doctor} at {time} are confirmed, "
+                  "from {date} to {last_date}."),
+    'completed': ("Treatment completed",
+                  "Dr. {doctor} has added the treatment notes for your visit on {date}. "
+                  "You can view them under My Bookings."),
+}
+
+
+def notify_patient(appointment, kind, **details):
+    """
+    Queues a notification for the appointment's patient. Call it before
+    db.session.commit(); the message is only sent if the commit succeeds.
+    details fill any extra placeholders in the NOTIFICATIONS text.
+    """
+    # Callers queue this before their own flush, which must not happen here
+    with db.session.no_autoflush:
+        patient = appointment.patient or db.session.get(User, appointment.patient_id)
+    doctor = schedule_cache.get_doctor(int(appointment.doctor_id))
+    if not patient or not patient.email:
+        return
+    subject, body = NOTIFICATIONS[kind]
+    db.session.add(OutboxMessage(
+        kind=kind,
+        recipient=patient.email,
+        subject=f"RAMMIDOC: {subject}",
+        body=f"Hello {patient.username},\n\n" + body.format(
+            doctor=doctor.doctorname if doctor else '', date=appointment.date, time=appointment.time, **details
+        ) + "\n\nRAMMIDOC Hospital",
+    ))
+    db.session.info['outbox_queued'] = True
+
+
+def deliver_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Sends one batch of due messages over a single SMTP connection.
+    Returns the number of messages attempted. Needs an app context.
+    """
+    now = datetime.now()
+    claimable = or_(
+        (OutboxMessage.status == 'pending') & (OutboxMessage.next_attempt_at <= now),
+        # A worker that died mid-batch leaves rows stuck in 'sending'
+        (OutboxMessage.status == 'sending') & (OutboxMessage.claimed_at < now - OUTBOX_CLAIM_TIMEOUT)
+    )
+    ids = db.session.scalars(
+        select(OutboxMessage.id).where(claimable).order_by(OutboxMessage.next_attempt_at).limit(batch_size)
+    ).all()
+    if not ids:
+        return 0
+
+    # Claim the batch under a fresh token. The UPDATE checks the condition
+    # again, so a worker that read the same ids claims only rows nobody took
+    # in between, and each worker sends just the rows carrying its token.
+    token = secrets.token_hex(16)
+    db.session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(ids), claimable)
+        .values(status='sending', claimed_at=now, claim_token=token)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    due = OutboxMessage.query.filter(
+        OutboxMessage.id.in_(ids), OutboxMessage.claim_token == token, OutboxMessage.status == 'sending'
+    ).order_by(OutboxMessage.next_attempt_at).all()
+    if not due:
+        return 0
+
+    def failed(message, error):
+        message.attempts += 1
+        message.last_error = str(error)[:500]
+        if message.attempts >= OUTBOX_MAX_ATTEMPTS:
+            message.status = 'failed'
+        else:
+            message.status = 'pending'
+            message.next_attempt_at = now + timedelta(seconds=OUTBOX_RETRY_BASE_SECONDS * 2 ** (message.attempts - 1))
+
+    try:
+        with mail.connect() as conn:
+            for message in due:
+                try:
+                    conn.send(Message(message.subject, recipients=[message.recipient], body=message.body))
+                    message.status = 'sent'
+                    message.attempts += 1
+                except smtplib.SMTPRecipientsRefused as e:
+                    failed(message, e)
+    except (smtplib.SMTPException, OSError) as e:
+        # Could not connect, or the connection dropped: retry everything not yet sent
+        for message in due:
+            if message.status == 'sending':
+                failed(message, e)
+    db.session.commit()
+    return len(due)
+
+
+class OutboxWorker:
+    """
+    Background thread that drains the outbox. create_app() starts it, and
+    wake() is called after a commit that queued mail so delivery starts right
+    away instead of at the next poll.
+    """
+    def __init__(self):
+        self.app = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, flask_app):
+        self.app = flask_app
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='outbox-worker', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def run(self, once=False):
+        while True:
+            self._wake.wait(OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    # Keep going while full batches come back
+                    while deliver_outbox() >= OUTBOX_BATCH_SIZE:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    print('[RAMMIDOC] Outbox delivery failed:', e)
+            if once:
+                return
+
+
+outbox_worker = OutboxWorker()
+
+
+@event.listens_for(db.session, 'after_commit')
+def wake_outbox_worker(session):
+    if session.info.pop('outbox_queued', False) and outbox_worker.app and outbox_worker.app.config['OUTBOX_AUTOSTART']:
+        outbox_worker.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_outbox_queued(session):
+    session.info.pop('outbox_queued', None)
+
+
+@main.cli.command('outbox-worker')
+def outbox_worker_command():
+    """Deliver queued email in this process (use with OUTBOX_AUTOSTART=False)."""
+    print('[RAMMIDOC] Outbox worker running, Ctrl+C to stop')
+    outbox_worker.run()
+
+
+# --- RAMMIDOC: audit log ---
+# Replaces the old MySQL triggers that wrote into 'trigr'. after_flush
+# collects what changed on the audited models, and before_commit writes all
+# of it with one multi-row INSERT in the same transaction. Rows carry a
+# 'period' (YYYY-MM) so retention can drop whole months at once.
+AUDITED_MODELS = {}  # model class -> table name, filled in below
+AUDIT_HIDDEN_FIELDS = {'password'}
+AUDIT_RETENTION_MONTHS = 12
+AUDIT_PAGE_SIZE = 50
+
+
+class AuditLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_audit_log_table_row', 'table_name', 'row_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False, index=True)  # e.g., "2025-11"
+    created_at = db.Column(db.DateTime, nullable=False)
+    table_name = db.Column(db.String(30), nullable=False)
+    row_id = db.Column(db.Integer)
+    action = db.Column(db.String(10), nullable=False)  # 'insert', 'update', 'delete'
+    actor_id = db.Column(db.Integer)   # logged-in user who made the change, if any
+    changes = db.Column(db.Text)       # JSON
+
+
+for _model in (User, Appointment, Treatment, DoctorAvailability):
+    AUDITED_MODELS[_model] = _model.__tablename__
+
+
+def current_actor_id():
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+
+def queue_audit(session, table_name, row_id, action, changes):
+    """
+    Adds one audit entry to be written when the session commits. Routes that
+    use bulk statements (which skip ORM events) call this directly.
+    """
+    now = datetime.now()
+    session.info.setdefault('audit_pending', []).append({
+        'period': now.strftime('%Y-%m'),
+        'created_at': now,
+        'table_name': table_name,
+        'row_id': row_id,
+        'action': action,
+        'actor_id': current_actor_id(),
+        'changes': json.dumps(changes, default=str),
+    })
+
+
+def _row_id(obj):
+    return inspect(obj).mapper.primary_key_from_instance(obj)[0]
+
+
+def _audit_snapshot(obj):
+    return {
+        attr.key: getattr(obj, attr.key)
+        for attr in inspect(obj).mapper.column_attrs
+        if attr.key not in AUDIT_HIDDEN_FIELDS
+    }
 
 
+@event.listens_for(db.session, 'after_flush')
+def collect_audit_entries(session, flush_context):
+    for obj in session.new:
+        if type(obj) in AUDITED_MODELS:
+            queue_audit(session, AUDITED_MODELS[type(obj)], _row_id(obj), 'insert', _audit_snapshot(obj))
+    for obj in session.dirty:
+        if type(obj) in AUDITED_MODELS:
+            changes = {}
+            for attr in inspect(obj).mapper.column_attrs:
+                change = _history(obj, attr.key)
+                if change:
+                    changes[attr.key] = '(changed)' if attr.key in AUDIT_HIDDEN_FIELDS else list(change)
+            if changes:
+                queue_audit(session, AUDITED_MODELS[type(obj)], _row_id(obj), 'update', changes)
+    for obj in session.deleted:
+        if type(obj) in AUDITED_MODELS:
+            queue_audit(session, AUDITED_MODELS[type(obj)], _row_id(obj), 'delete', _audit_snapshot(obj))
+
+
+@event.listens_for(db.session, 'before_commit')
+def write_audit_entries(session):
+    # Flush first so changes still pending at commit time are collected too
+    session.flush()
+    entries = session.info.pop('audit_pending', None)
+    if entries:
+        session.connection().execute(insert(AuditLog), entries)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_audit_entries(session):
+    session.info.pop('audit_pending', None)
+
+
+def prune_audit_log(months=AUDIT_RETENTION_MONTHS):
+    """
+    Deletes every audit period older than the given number of months
+    """
+    today = datetime.now()
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    cutoff = f"{year:04d}-{month + 1:02d}"
+    deleted = AuditLog.query.filter(AuditLog.period < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return cutoff, deleted
+
+
+@main.cli.command('prune-audit')
+@click.option('--months', default=AUDIT_RETENTION_MONTHS, show_default=True, help='Months of audit history to keep.')
+def prune_audit_command(months):
+    """Drop audit log periods older than the retention window."""
+    cutoff, deleted = prune_audit_log(months)
+    print(f'[RAMMIDOC] Removed {deleted} audit entries before {cutoff}')
+
+
+# --- RAMMIDOC: password hashing and login throttling ---
+# All hashing goes through hash_password()/verify_password() so the cost is
+# set in one place (PASSWORD_HASH_METHOD). A login that succeeds against a
+# hash made with other parameters schedules a rehash on a background thread,
+# so the user's request does not pay for a second hash.
+_rehash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rehash')
+_method_prefixes = {}
+
+
+def hash_method_prefix(method):
+    """
+    The 'method' part werkzeug writes for a config value ('scrypt' -> 'scrypt:32768:8:1')
+    """
+    if method not in _method_prefixes:
+        _method_prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return _method_prefixes[method]
+
+
+def hash_password(password):
+    with timed('hash_seconds'):
+        return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def needs_rehash(stored_hash):
+    return stored_hash.split('$', 1)[0] != hash_method_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
 
-@app.route('/')
+def _rehash(flask_app, user_id, old_hash, password):
+    with flask_app.app_context():
+        new_hash = hash_password(password)
+        # Only replace the hash we checked, in case the password changed meanwhile
+        db.session.execute(
+            update(User).where(User.id == user_id, User.password == old_hash).values(password=new_hash)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+
+def verify_password(user, password):
+    if not user or not user.password or not password:
+        return False
+    with timed('hash_seconds'):
+        if not check_password_hash(user.password, password):
+            return False
+    if needs_rehash(user.password):
+        _rehash_pool.submit(_rehash, current_app._get_current_object(), user.id, user.password, password)
+    return True
+
+
+class LoginThrottle:
+    """
+    Counts failed logins per key (email or client IP) over a sliding window.
+    Process-local: with several workers each one keeps its own count.
+    """
+    SWEEP_EVERY = 256   # failed() calls between sweeps of expired keys
+
+    def __init__(self):
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def _recent(self, key, now):
+        window = current_app.config['LOGIN_FAILURE_WINDOW']
+        failures = self._failures.get(key)
+        while failures and failures[0] <= now - window:
+            failures.popleft()
+        if failures is not None and not failures:
+            del self._failures[key]
+            return 0
+        return len(failures or ())
+
+    def is_blocked(self, email, ip, known=False):
+        """
+        A busy IP (a hospital NAT, a proxy) only blocks emails that are unknown
+        or already failing, so a correct password for a clean account gets through
+        """
+        now = monotonic()
+        with self._lock:
+            email_failures = self._recent(('email', email), now)
+            if email_failures >= current_app.config['LOGIN_MAX_FAILURES_PER_EMAIL']:
+                return True
+            return ((not known or email_failures > 0)
+                    and self._recent(('ip', ip), now) >= current_app.config['LOGIN_MAX_FAILURES_PER_IP'])
+
+    def failed(self, email, ip):
+        now = monotonic()
+        with self._lock:
+            for key in (('email', email), ('ip', ip)):
+                self._failures.setdefault(key, deque()).append(now)
+            self._calls += 1
+            if self._calls >= self.SWEEP_EVERY:
+                # Keys that are never looked up again would otherwise stay forever
+                self._calls = 0
+                for key in list(self._failures):
+                    self._recent(key, now)
+
+    def succeeded(self, email):
+        with self._lock:
+            self._failures.pop(('email', email), None)
+
+
+login_throttle = LoginThrottle()
+
+
+@main.cli.command('bench-hash')
+@click.option('--rounds', default=20, show_default=True, help='Password checks per method.')
+@click.argument('methods', nargs=-1)
+def bench_hash_command(rounds, methods):
+    """Report logins/sec per worker for each hashing cost."""
+    methods = methods or (
+        'scrypt:8192:8:1', 'scrypt:16384:8:1', 'scrypt:32768:8:1',
+        'pbkdf2:sha256:260000', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000',
+    )
+    configured = hash_method_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+    print(f"{'method':<26}{'ms/login':>10}{'logins/sec':>12}")
+    for method in methods:
+        stored = generate_password_hash('benchmark-password', method=method)
+        started = perf_counter()
+        for _ in range(rounds):
+            check_password_hash(stored, 'benchmark-password')
+        per_login = (perf_counter() - started) / rounds
+        marker = '  <- configured' if hash_method_prefix(method) == configured else ''
+        print(f"{method:<26}{per_login * 1000:>10.1f}{1 / per_login:>12.1f}{marker}")
+
+
+@main.route('/')
 def index():
     return render_template('index.html')
     
 
 
-@app.route('/doctors',methods=['POST','GET'])
+@main.route('/doctors',methods=['POST','GET'])
 def doctors():
 
     if request.method=="POST":
@@ -159,141 +1254,589 @@ def doctors():
         new_doctor = Doctors(email=email, doctorname=doctorname, dept=dept)
         db.session.add(new_doctor)
         db.session.commit()
+        schedule_cache.invalidate()
         flash("Information is Stored","primary")
 
     return render_template('doctor.html')
 
 
 
-@app.route('/patients',methods=['POST','GET'])
+@main.route('/patients',methods=['POST','GET'])
 @login_required
 def patient():
     # GET request: Just show the form and the list of doctors
-    doct=Doctors.query.all()
+    doct=schedule_cache.get_roster()
 
     if request.method=="POST":
         # Get data from the form
         time=request.form.get('time')
         date_str=request.form.get('date') # Renamed to avoid confusion
         disease=request.form.get('disease')
-        doctor_id=request.form.get('doctor_id') 
+        doctor_id=request.form.get('doctor_id', type=int)
+        dept=request.form.get('dept')
+
+        if request.form.get('doctor_id') == 'any':
+            # Let the load index pick the least busy doctor in the department
+            booking_date_obj = parse_slot(date_str, time)
+            if booking_date_obj is None:
+                flash("Invalid date format. Please try again.", "danger")
+                return render_template('patient.html',doct=doct)
+            if not dept:
+                flash("Please select a department.", "danger")
+                return render_template('patient.html',doct=doct)
+            doctor = book_any_doctor(dept, booking_date_obj.date(), time, disease)
+            if not doctor:
+                flash(f"No doctor in {dept} is free at {time} on {date_str}. Please choose another time.", "danger")
+                return render_template('patient.html',doct=doct)
+            flash(f"Booking Confirmed with Dr. {doctor.doctorname}!","info")
+            return redirect(url_for('main.bookings'))
+
+        # Get the doctor's info for flash messages
+        doctor = schedule_cache.get_doctor(doctor_id)
+        if not doctor:
+            flash("Please select a doctor.", "danger")
+            return render_template('patient.html',doct=doct)
 
         # --- NEW: Doctor Availability Check ---
-        try:
-            # 1. Convert date string to datetime object
-            booking_date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-            # 2. Get the full day name (e.g., "Thursday")
-            day_name = booking_date_obj.strftime('%A')
-        except ValueError:
+        # 1. Convert date and time strings to a datetime object
+        booking_date_obj = parse_slot(date_str, time)
+        if booking_date_obj is None:
             flash("Invalid date format. Please try again.", "danger")
             return render_template('patient.html',doct=doct)
+        # 2. Get the full day name (e.g., "Thursday")
+        day_name = booking_date_obj.strftime('%A')
 
-        # 3. Find the doctor's schedule for that day
-        doctor_schedule = DoctorAvailability.query.filter_by(
-            doctor_id=doctor_id,
-            day_name=day_name
-        ).first()
-
-        # 4. Get the doctor's info for flash messages
-        doctor = Doctors.query.get(doctor_id)
+        # 3. Find the doctor's hours for that date (cached, date overrides applied)
+        start_time, end_time = schedule_cache.get_hours(doctor.did, booking_date_obj.date())
 
-        # 5. Validation Check 1: Is the doctor working at all?
-        if not doctor_schedule or not doctor_schedule.start_time or not doctor_schedule.end_time:
-            flash(f"Dr. {doctor.doctorname} is not available on {day_name}s. Please select a different day.", "danger")
+        # 4. Validation Check 1: Is the doctor working at all?
+        if not start_time or not end_time:
+            flash(f"Dr. {doctor.doctorname} is not available on {day_name}, {date_str}. Please select a different day.", "danger")
             return render_template('patient.html',doct=doct)
 
-        # 6. Validation Check 2: Is the time within working hours?
+        # 5. Validation Check 2: Is the time within working hours?
         # We can compare times as strings (e.g., "09:00" <= "10:30" < "17:00")
-        if not (doctor_schedule.start_time <= time < doctor_schedule.end_time):
-            flash(f"The selected time {time} is outside Dr. {doctor.doctorname}'s hours ({doctor_schedule.start_time} - {doctor_schedule.end_time}) on {day_name}s.", "danger")
+        if not (start_time <= time < end_time):
+            flash(f"The selected time {time} is outside Dr. {doctor.doctorname}'s hours ({start_time} - {end_time}) on {day_name}, {date_str}.", "danger")
             return render_template('patient.html',doct=doct)
         
         # --- END OF NEW LOGIC ---
 
-        # --- CORE REQUIREMENT: Check for conflicts (Existing Logic) ---
-        conflict = Appointment.query.filter_by(
-            doctor_id=doctor_id,
-            date=date_str, # Use the string version
-            time=time
-        ).first()
-
-        if conflict:
-            flash(f"Dr. {doctor.doctorname} is already booked at {time} on {date_str}. Please choose another time.", "danger")
-            return render_template('patient.html',doct=doct)
-        
         # --- Create the new appointment ---
+        # No separate conflict query: uq_appointment_active_slot rejects a
+        # double booking, even when two workers insert at the same moment.
         new_appointment = Appointment(
             time=time,
             date=date_str, # Use the string version
             disease=disease,
             status='Booked',
             patient_id=current_user.id, # Link to the logged-in patient
-            doctor_id=doctor_id         # Link to the chosen doctor
+            doctor_id=doctor.did        # Link to the chosen doctor
         )
 
         db.session.add(new_appointment)
-        db.session.commit()
-        
-        # You can re-enable your mail send logic here if you want
-        # mail.send_message(...)
+        notify_patient(new_appointment, 'booked')
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not is_slot_conflict(e):
+                raise
+            flash(f"Dr. {doctor.doctorname} is already booked at {time} on {date_str}. Please choose another time.", "danger")
+            return render_template('patient.html',doct=doct)
+        # The confirmation email is sent by the outbox worker, off the request
 
         flash("Booking Confirmed!","info")
-        return redirect(url_for('bookings')) # Redirect to see the booking
+        return redirect(url_for('main.bookings')) # Redirect to see the booking
 
 
     return render_template('patient.html',doct=doct)
 
-@app.route('/bookings')
+# --- RAMMIDOC: free slot finder ---
+DEFAULT_SLOT_MINUTES = 30
+MAX_SLOT_RANGE_DAYS = 31
+
+
+TIME_PATTERN = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+
+
+def valid_hours(start_time, end_time):
+    """
+    True for a pair of HH:MM times with start before end
+    """
+    return bool(start_time and end_time and TIME_PATTERN.match(start_time)
+                and TIME_PATTERN.match(end_time) and start_time < end_time)
+
+
+def to_minutes(hhmm):
+    hours, minutes = hhmm.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def from_minutes(total):
+    return f"{total // 60:02d}:{total % 60:02d}"
+
+
+def find_free_slots(doctors, start_date, end_date, slot_minutes, now=None):
+    """
+    Works out every open slot for the given doctors between two dates (inclusive).
+
+    Working hours come from schedule_cache (missing schedules are loaded in
+    one go) and all live appointments in the range are read with a single
+    query; the rest is done in memory. A booked appointment blocks any slot
+    that overlaps [time, time + slot_minutes).
+    Returns {doctor_id: {'YYYY-MM-DD': ['HH:MM', ...]}}.
+    """
+    now = now or datetime.now()
+    doctor_ids = [d.did for d in doctors]
+    schedule_cache.preload(doctor_ids)
+
+    booked = {}  # (doctor_id, date) -> [start minutes, ...]
+    rows = db.session.query(Appointment.doctor_id, Appointment.date, Appointment.time).filter(
+        Appointment.doctor_id.in_(doctor_ids),
+        Appointment.starts_at >= datetime.combine(start_date, time()),
+        Appointment.starts_at < datetime.combine(end_date + timedelta(days=1), time()),
+        Appointment.status != 'Cancelled'
+    ).all()
+    for doctor_id, date_str, time_str in rows:
+        try:
+            booked.setdefault((doctor_id, date_str), []).append(to_minutes(time_str))
+        except ValueError:
+            continue  # Legacy free-form time, nothing to block
+
+    result = {}
+    for doctor in doctors:
+        days = {}
+        day = start_date
+        while day <= end_date:
+            date_str = day.isoformat()
+            start_time, end_time = schedule_cache.get_hours(doctor.did, day)
+            # Hours saved before they were validated may not parse: day off
+            if valid_hours(start_time, end_time):
+                taken = booked.get((doctor.did, date_str), [])
+                slots = []
+                slot = to_minutes(start_time)
+                while slot + slot_minutes <= to_minutes(end_time):
+                    in_past = datetime.combine(day, time()) + timedelta(minutes=slot) < now
+                    overlaps = any(b < slot + slot_minutes and slot < b + slot_minutes for b in taken)
+                    if not in_past and not overlaps:
+                        slots.append(from_minutes(slot))
+                    slot += slot_minutes
+                if slots:
+                    days[date_str] = slots
+            day += timedelta(days=1)
+        result[doctor.did] = days
+    return result
+
+
+@main.route('/api/free-slots')
+@login_required
+def free_slots():
+    """
+    GET /api/free-slots?doctor_id=3&start=2025-11-17&end=2025-11-23&slot_minutes=30
+    Use dept=<department> instead of doctor_id to search a whole department.
+    'end' defaults to 'start'.
+    """
+    try:
+        start_date = datetime.strptime(request.args.get('start', ''), '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args.get('end') or start_date.isoformat(), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify(error="start and end must be YYYY-MM-DD dates"), 400
+    if end_date < start_date or (end_date - start_date).days >= MAX_SLOT_RANGE_DAYS:
+        return jsonify(error=f"Date range must be 1 to {MAX_SLOT_RANGE_DAYS} days"), 400
+
+    slot_minutes = request.args.get('slot_minutes', DEFAULT_SLOT_MINUTES, type=int)
+    if not slot_minutes or not 5 <= slot_minutes <= 240:
+        return jsonify(error="slot_minutes must be between 5 and 240"), 400
+
+    doctor_id = request.args.get('doctor_id', type=int)
+    dept = request.args.get('dept')
+    roster = schedule_cache.get_roster()
+    if doctor_id:
+        doctors = [d for d in roster if d.did == doctor_id]
+    elif dept:
+        doctors = [d for d in roster if d.dept == dept]
+    else:
+        return jsonify(error="Give a doctor_id or a dept"), 400
+    if not doctors:
+        return jsonify(error="No matching doctors"), 404
+
+    slots = find_free_slots(doctors, start_date, end_date, slot_minutes)
+    return jsonify(
+        start=start_date.isoformat(),
+        end=end_date.isoformat(),
+        slot_minutes=slot_minutes,
+        doctors=[
+            {'doctor_id': d.did, 'doctorname': d.doctorname, 'dept': d.dept, 'slots': slots[d.did]}
+            for d in doctors
+        ]
+    )
+
+
+# --- RAMMIDOC: department load index ---
+# "Any doctor in department" bookings go to the least-loaded doctor who is
+# free at the requested time. For each (dept, date) in use the index keeps
+# the booked times per doctor and a min-heap of (booked count, doctor id),
+# so picking a doctor pops O(log n) instead of counting every doctor's day.
+# Commits that book, cancel or move an appointment patch the loaded days in
+# place; schedule edits (schedule_cache.generation) and the TTL rebuild them.
+LOAD_INDEX_TTL = 60  # seconds, covers bookings made by other processes
+LOAD_INDEX_DAYS = 512
+
+
+class DepartmentLoadIndex:
+    def __init__(self, ttl, max_days):
+        self.ttl = ttl
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        # (dept, date) -> (expires_at, generation, {doctor_id: {times}}, [(count, doctor_id), ...])
+        self._days = OrderedDict()
+        self._dept_of = {}  # doctor_id -> dept, for routing apply()
+
+    def _build(self, dept, day):
+        members = [d.did for d in schedule_cache.get_roster() if (d.dept or '') == dept]
+        schedule_cache.preload(members)
+        doctors = [did for did in members if schedule_cache.get_hours(did, day)[0]]
+        for did in doctors:
+            self._dept_of[did] = dept
+        taken = {did: set() for did in doctors}
+        if doctors:
+            rows = db.session.query(Appointment.doctor_id, Appointment.time).filter(
+                Appointment.doctor_id.in_(doctors),
+                Appointment.starts_at >= datetime.combine(day, time()),
+                Appointment.starts_at < datetime.combine(day + timedelta(days=1), time()),
+                Appointment.status != 'Cancelled'
+            ).all()
+            for doctor_id, time_str in rows:
+                taken[doctor_id].add(time_str)
+        heap = [(len(times), did) for did, times in taken.items()]
+        heapq.heapify(heap)
+        return taken, heap
+
+    def _entry(self, dept, day):
+        key = (dept, day.isoformat())
+        generation = schedule_cache.generation
+        with self._lock:
+            entry = self._days.get(key)
+            if entry and entry[0] > monotonic() and entry[1] == generation:
+                self._days.move_to_end(key)
+                return entry
+        taken, heap = self._build(dept, day)
+        entry = (monotonic() + self.ttl, generation, taken, heap)
+        with self._lock:
+            self._days[key] = entry
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+        return entry
+
+    def pick(self, dept, day, time_str):
+        """
+        Doctor id of the least-loaded doctor in dept who works at time_str on
+        day and has that slot free, or None. Ties go to the lowest doctor id.
+        """
+        _, _, taken, heap = self._entry(dept or '', day)
+        with self._lock:
+            skipped, seen, chosen = [], set(), None
+            while heap:
+                count, did = heapq.heappop(heap)
+                if did in seen or count != len(taken[did]):
+                    continue  # Stale entry left behind by apply()
+                seen.add(did)
+                skipped.append((count, did))
+                start_time, end_time = schedule_cache.get_hours(did, day)
+                if start_time and start_time <= time_str < end_time and time_str not in taken[did]:
+                    chosen = did
+                    break
+            for item in skipped:
+                heapq.heappush(heap, item)
+        return chosen
+
+    def apply(self, changes):
+        """
+        Applies [(doctor_id, date, time, +1 or -1), ...] to the loaded days
+        """
+        with self._lock:
+            for doctor_id, date_str, time_str, sign in changes:
+                entry = self._days.get((self._dept_of.get(doctor_id), date_str))
+                if entry is None or doctor_id not in entry[2]:
+                    continue  # Day not in use, or doctor not working that day
+                times = entry[2][doctor_id]
+                if sign > 0:
+                    times.add(time_str)
+                else:
+                    times.discard(time_str)
+                heapq.heappush(entry[3], (len(times), doctor_id))
+
+    def invalidate(self, dept=None, day=None):
+        """
+        Drops one (dept, day), or everything when no department is given
+        """
+        with self._lock:
+            if dept is None:
+                self._days.clear()
+                self._dept_of.clear()
+            else:
+                self._days.pop((dept or '', day.isoformat()), None)
+
+
+load_index = DepartmentLoadIndex(LOAD_INDEX_TTL, LOAD_INDEX_DAYS)
+ANY_DOCTOR_ATTEMPTS = 3
+
+
+def book_any_doctor(dept, day, time_str, disease):
+    """
+    Books the current patient with the least-loaded doctor in dept who is
+    free at time_str on day, and commits. pick() does not reserve the slot,
+    so when another booking takes it first the day is rebuilt from the
+    database and the next doctor is tried. Returns the DoctorInfo, or None
+    when nobody in the department is free.
+    """
+    for _ in range(ANY_DOCTOR_ATTEMPTS):
+        doctor = schedule_cache.get_doctor(load_index.pick(dept, day, time_str))
+        if not doctor:
+            return None
+        appointment = Appointment(time=time_str, date=day.isoformat(), disease=disease, status='Booked',
+                                  patient_id=current_user.id, doctor_id=doctor.did)
+        db.session.add(appointment)
+        notify_patient(appointment, 'booked')
+        try:
+            db.session.commit()
+            return doctor
+        except IntegrityError as e:
+            db.session.rollback()
+            if not is_slot_conflict(e):
+                raise
+            load_index.invalidate(dept, day)
+    return None
+
+
+def _live_slot(doctor_id, status, date_str, time_str):
+    if (status or 'Booked') == 'Cancelled' or doctor_id is None:
+        return None
+    return int(doctor_id), date_str, time_str
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_load_changes(session, flush_context, instances):
+    changes = session.info.setdefault('load_changes', [])
+
+    def move(old, new):
+        if old != new:
+            if old:
+                changes.append(old + (-1,))
+            if new:
+                changes.append(new + (1,))
+
+    for obj in session.new:
+        if isinstance(obj, Appointment):
+            move(None, _live_slot(obj.doctor_id, obj.status, obj.date, obj.time))
+    for obj in session.dirty:
+        if isinstance(obj, Appointment):
+            history = {attr: _history(obj, attr) for attr in ('doctor_id', 'status', 'date', 'time')}
+            if any(history.values()):
+                old = {attr: change[0] if change else getattr(obj, attr) for attr, change in history.items()}
+                move(_live_slot(old['doctor_id'], old['status'], old['date'], old['time']),
+                     _live_slot(obj.doctor_id, obj.status, obj.date, obj.time))
+    for obj in session.deleted:
+        if isinstance(obj, Appointment):
+            move(_live_slot(obj.doctor_id, obj.status, obj.date, obj.time), None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_load_changes(session):
+    changes = session.info.pop('load_changes', None)
+    if changes:
+        load_index.apply(changes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_load_changes(session):
+    session.info.pop('load_changes', None)
+
+
+# --- RAMMIDOC: recurring bookings ---
+MAX_OCCURRENCES = 52
+
+
+def expand_recurrence(first_date, interval_weeks=1, count=None, until=None):
+    """
+    Dates of a weekly rule ending after count occurrences or on until,
+    never more than MAX_OCCURRENCES (book_recurring rejects longer rules)
+    """
+    dates = []
+    day = first_date
+    while len(dates) < min(count or MAX_OCCURRENCES, MAX_OCCURRENCES) and (until is None or day <= until):
+        dates.append(day)
+        day += timedelta(weeks=interval_weeks)
+    return dates
+
+
+def check_occurrences(doctor, dates, time_str, now=None):
+    """
+    Returns {date: problem or None} for booking doctor at time_str on each date.
+    Working hours come from the schedule cache and existing bookings for all
+    dates are read with one query.
+    """
+    now = now or datetime.now()
+    taken = set(db.session.scalars(select(Appointment.date).where(
+        Appointment.doctor_id == doctor.did,
+        Appointment.time == time_str,
+        Appointment.date.in_([day.isoformat() for day in dates]),
+        Appointment.status != 'Cancelled',  # same rule as uq_appointment_active_slot
+    )))
+    problems = {}
+    for day in dates:
+        start_time, end_time = schedule_cache.get_hours(doctor.did, day)
+        if parse_slot(day.isoformat(), time_str) <= now:
+            problems[day] = 'past'
+        elif not start_time or not end_time:
+            problems[day] = 'unavailable'
+        elif not (start_time <= time_str < end_time):
+            problems[day] = 'outside_hours'
+        elif day.isoformat() in taken:
+            problems[day] = 'conflict'
+        else:
+            problems[day] = None
+    return problems
+
+
+@main.route('/api/appointments/recurring', methods=['POST'])
+@login_required
+def book_recurring():
+    """
+    POST {"doctor_id": 3, "date": "2025-11-17", "time": "10:00", "disease": "physio", "count": 8}
+    as JSON or form data. Give "until": "2026-01-31" instead of "count" to book up
+    to a date, and "interval_weeks" for fortnightly and longer rules.
+    All occurrences are booked in one transaction. If any of them cannot be
+    booked, nothing is, unless "partial" is true. The response has one result
+    per occurrence.
+    """
+    data = request.get_json(silent=True) or request.form
+    if current_user.usertype != 'Patient':
+        return jsonify(error="Only patients can book appointments"), 403
+    try:
+        doctor_id = int(data.get('doctor_id') or 0)
+        interval_weeks = int(data.get('interval_weeks') or 1)
+        count = int(data['count']) if data.get('count') else None
+        first_date = datetime.strptime(str(data.get('date', '')), '%Y-%m-%d').date()
+        until = datetime.strptime(str(data['until']), '%Y-%m-%d').date() if data.get('until') else None
+    except (TypeError, ValueError):
+        return jsonify(error="doctor_id, count and interval_weeks must be numbers; date and until YYYY-MM-DD"), 400
+    time_str = str(data.get('time', ''))
+    partial = str(data.get('partial', '')).lower() in ('1', 'true', 'yes', 'on')
+
+    doctor = schedule_cache.get_doctor(doctor_id)
+    if not doctor:
+        return jsonify(error="No such doctor"), 404
+    if parse_slot(first_date.isoformat(), time_str) is None:
+        return jsonify(error="time must be HH:MM"), 400
+    if not count and not until:
+        return jsonify(error="Give a count or an until date"), 400
+    if not 1 <= interval_weeks <= 52 or (count is not None and count < 1):
+        return jsonify(error="interval_weeks must be 1 to 52 and count at least 1"), 400
+    wanted = [count] if count else []
+    if until:
+        wanted.append(max((until - first_date).days // (7 * interval_weeks) + 1, 0))
+    if min(wanted) > MAX_OCCURRENCES:
+        return jsonify(error=f"A series can have at most {MAX_OCCURRENCES} occurrences"), 400
+
+    dates = expand_recurrence(first_date, interval_weeks, count, until)
+    problems = check_occurrences(doctor, dates, time_str)
+    bookable = [day for day in dates if problems[day] is None]
+    if not bookable or (len(bookable) < len(dates) and not partial):
+        bookable = []
+    appointments = {
+        day: Appointment(time=time_str, date=day.isoformat(), disease=data.get('disease'), status='Booked',
+                         patient_id=current_user.id, doctor_id=doctor.did)
+        for day in bookable
+    }
+    if appointments:
+        db.session.add_all(appointments.values())
+        first = appointments[bookable[0]]
+        notify_patient(first, 'recurring', count=len(appointments), last_date=bookable[-1].isoformat())
+        try:
+            db.session.flush()
+            # Read the ids now; after commit each would cost a refresh query
+            booked_ids = {day: appointment.id for day, appointment in appointments.items()}
+            db.session.commit()
+        except IntegrityError as e:
+            # Someone took one of the slots after the check
+            db.session.rollback()
+            if not is_slot_conflict(e):
+                raise
+            problems = check_occurrences(doctor, dates, time_str)
+            booked_ids = {}
+    else:
+        booked_ids = {}
+
+    occurrences = []
+    for day in dates:
+        if day in booked_ids:
+            occurrences.append({'date': day.isoformat(), 'status': 'booked', 'appointment_id': booked_ids[day]})
+        else:
+            occurrences.append({'date': day.isoformat(), 'status': problems[day] or 'not_booked'})
+    return jsonify(
+        doctor_id=doctor.did,
+        time=time_str,
+        booked=len(booked_ids),
+        occurrences=occurrences
+    ), 201 if booked_ids else 409
+
+
+@main.route('/bookings')
 @login_required
 def bookings(): 
     if current_user.usertype=="Doctor":
         # Find the doctor profile linked to the logged-in user's email
-        doctor = Doctors.query.filter_by(email=current_user.email).first()
+        doctor = get_current_doctor()
         
         if doctor:
             # Doctor sees appointments linked to their doctor_id
-            query = Appointment.query.filter_by(doctor_id=doctor.did).order_by(Appointment.date, Appointment.time).all()
+            # (patient and doctor arrive in the same SELECT, see with_people)
+            query = Appointment.query.options(*with_people()).filter_by(doctor_id=doctor.did).order_by(Appointment.date, Appointment.time).all()
+            waitlist = WaitlistEntry.query.options(*with_people(WaitlistEntry)).filter(
+                WaitlistEntry.doctor_id == doctor.did, WaitlistEntry.status == 'waiting',
+                WaitlistEntry.date >= datetime.now().strftime('%Y-%m-%d')
+            ).order_by(WaitlistEntry.date, WaitlistEntry.priority.desc(), WaitlistEntry.created_at).all()
         else:
             query = [] # Or flash a message "Please complete your doctor profile"
+            waitlist = []
         
-        return render_template('booking.html',query=query)
+        return render_template('booking.html',query=query,waitlist=waitlist)
     
     else: # Assumes "Patient"
         # Patient sees appointments linked to their patient_id
-        query = Appointment.query.filter_by(patient_id=current_user.id).order_by(Appointment.date, Appointment.time).all()
-        return render_template('booking.html',query=query)
+        query = Appointment.query.options(*with_people()).filter_by(patient_id=current_user.id).order_by(Appointment.date, Appointment.time).all()
+        waitlist = WaitlistEntry.query.options(*with_people(WaitlistEntry)).filter(
+            WaitlistEntry.patient_id == current_user.id, WaitlistEntry.status == 'waiting',
+            WaitlistEntry.date >= datetime.now().strftime('%Y-%m-%d')
+        ).order_by(WaitlistEntry.date).all()
+        return render_template('booking.html',query=query,waitlist=waitlist)
     
 
 
-@app.route("/edit/<int:id>",methods=['POST','GET']) # Use <int:id>
+@main.route("/edit/<int:id>",methods=['POST','GET']) # Use <int:id>
 @login_required
 def edit(id):
     # Find the appointment by its ID
-    appointment = Appointment.query.get_or_404(id)
+    appointment = db.get_or_404(Appointment, id)
 
     # --- Security Check: Only the patient can edit their own appointment ---
     if appointment.patient_id != current_user.id:
         flash("You do not have permission to edit this appointment.", "danger")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
 
     if request.method=="POST":
         # Get new details from form
         new_time=request.form.get('time')
         new_date=request.form.get('date')
-        
-        # --- Conflict Check ---
-        conflict = Appointment.query.filter(
-            Appointment.doctor_id == appointment.doctor_id,
-            Appointment.date == new_date,
-            Appointment.time == new_time,
-            Appointment.id != id  # Exclude the appointment itself
-        ).first()
-
-        if conflict:
-            flash(f"That time slot is already booked. Please choose another.", "danger")
-            return render_template('edit.html', posts=appointment) # Stay on page
 
+        if parse_slot(new_date, new_time) is None:
+            flash("Invalid date format. Please try again.", "danger")
+            return render_template('edit.html', posts=appointment)
+        
         # Update the appointment
+        old_date, old_time = appointment.date, appointment.time
         appointment.time = new_time
         appointment.date = new_date
         appointment.disease = request.form.get('disease')
@@ -301,7 +1844,22 @@ def edit(id):
         # appointment, but they should really be part of the User (Patient) profile.
         # For now, we just update what's in the model.
         
-        db.session.commit()
+        notify_patient(appointment, 'rescheduled')
+
+        # --- Conflict Check (enforced by uq_appointment_active_slot) ---
+        try:
+            if appointment.status == 'Booked' and (old_date, old_time) != (new_date, new_time):
+                # Write the move first so the old slot is free, then hand it to
+                # the waitlist in the same transaction
+                db.session.flush()
+                backfill_slot(appointment.doctor_id, old_date, old_time)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not is_slot_conflict(e):
+                raise
+            flash(f"That time slot is already booked. Please choose another.", "danger")
+            return render_template('edit.html', posts=appointment) # Stay on page
         flash("Appointment Successfully Updated","success")
         return redirect('/bookings')
     
@@ -309,25 +1867,179 @@ def edit(id):
     return render_template('edit.html',posts=appointment)
 
 
-@app.route("/delete/<int:id>",methods=['POST','GET']) # Use <int:id>
+@main.route("/delete/<int:id>",methods=['POST','GET']) # Use <int:id>
 @login_required
 def delete(id):
-    appointment = Appointment.query.get_or_404(id)
+    appointment = db.get_or_404(Appointment, id)
 
     # --- Security Check: Only the patient can cancel ---
     if appointment.patient_id != current_user.id:
         flash("You do not have permission to cancel this appointment.", "danger")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
 
     # --- Update status instead of deleting ---
+    was_booked = appointment.status == 'Booked'
     appointment.status = "Cancelled"
+    notify_patient(appointment, 'cancelled')
+    if was_booked:
+        # The cancellation and the waitlist booking commit together
+        db.session.flush()
+        backfill_slot(appointment.doctor_id, appointment.date, appointment.time)
     db.session.commit()
     
     flash("Appointment Successfully Cancelled","warning")
     return redirect('/bookings')
 
 
-@app.route('/signup',methods=['POST','GET'])
+# --- RAMMIDOC: waitlist ---
+class WaitlistEntry(db.Model):
+    """
+    A patient waiting for any slot with a doctor on a date, optionally within
+    a time window. Higher priority goes first, then first come first served.
+    """
+    __tablename__ = 'waitlist_entry'
+    __table_args__ = (
+        db.Index('ix_waitlist_queue', 'doctor_id', 'date', 'status', 'priority', 'created_at'),
+        # One open entry per patient, doctor and date
+        db.Index(
+            'uq_waitlist_waiting', 'patient_id', 'doctor_id', 'date', unique=True,
+            sqlite_where=text("status = 'waiting'"), postgresql_where=text("status = 'waiting'")
+        ),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.String(10), nullable=False)    # e.g., "2025-12-24"
+    start_time = db.Column(db.String(5), nullable=True) # earliest acceptable, e.g., "09:00"
+    end_time = db.Column(db.String(5), nullable=True)   # latest start (exclusive)
+    disease = db.Column(db.String(50))
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(10), nullable=False, default='waiting')  # 'waiting', 'booked', 'left', 'expired'
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.did'), nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True)
+
+    patient = db.relationship('User', lazy='select')
+    doctor = db.relationship('Doctors', lazy='select')
+
+
+def backfill_slot(doctor_id, date_str, time_str):
+    """
+    Books a freed slot for the first waiting patient whose window covers it.
+    Runs in the caller's transaction, so the slot is never free in between.
+    Returns the new Appointment, or None if nobody is waiting for it.
+    """
+    slot = parse_slot(date_str, time_str)
+    if slot is None or slot <= datetime.now():
+        return None
+
+    # Entries for days that have passed can never be served: close them
+    WaitlistEntry.query.filter(
+        WaitlistEntry.doctor_id == doctor_id,
+        WaitlistEntry.date < datetime.now().strftime('%Y-%m-%d'),
+        WaitlistEntry.status == 'waiting',
+    ).update({'status': 'expired'}, synchronize_session=False)
+
+    # Skip patients who already got a slot with this doctor that day
+    already_booked = select(Appointment.id).where(
+        Appointment.patient_id == WaitlistEntry.patient_id,
+        Appointment.doctor_id == doctor_id,
+        Appointment.date == date_str,
+        Appointment.status == 'Booked',
+    ).exists()
+    entry = WaitlistEntry.query.filter(
+        WaitlistEntry.doctor_id == doctor_id,
+        WaitlistEntry.date == date_str,
+        WaitlistEntry.status == 'waiting',
+        or_(WaitlistEntry.start_time.is_(None), WaitlistEntry.start_time <= time_str),
+        or_(WaitlistEntry.end_time.is_(None), WaitlistEntry.end_time > time_str),
+        ~already_booked,
+    ).order_by(
+        WaitlistEntry.priority.desc(), WaitlistEntry.created_at, WaitlistEntry.id
+    ).with_for_update(skip_locked=True, of=WaitlistEntry).first()
+    if not entry:
+        return None
+
+    appointment = Appointment(
+        time=time_str, date=date_str, disease=entry.disease, status='Booked',
+        patient_id=entry.patient_id, doctor_id=doctor_id,
+    )
+    db.session.add(appointment)
+    db.session.flush()
+    entry.status = 'booked'
+    entry.appointment_id = appointment.id
+    notify_patient(appointment, 'waitlist')
+    return appointment
+
+
+@main.route('/waitlist', methods=['POST'])
+@login_required
+def join_waitlist():
+    doctor = schedule_cache.get_doctor(request.form.get('doctor_id', type=int))
+    date_str = request.form.get('date', '')
+    start_time = request.form.get('start_time') or None
+    end_time = request.form.get('end_time') or None
+    day = parse_slot(date_str, start_time or '00:00')
+
+    if current_user.usertype != 'Patient' or not doctor:
+        flash("Please select a doctor.", "danger")
+        return redirect(url_for('main.patient'))
+    if day is None or day.date() < datetime.now().date():
+        flash("Please choose today or a later date.", "danger")
+        return redirect(url_for('main.patient'))
+    if start_time and end_time and start_time >= end_time:
+        flash("The earliest time must be before the latest time.", "danger")
+        return redirect(url_for('main.patient'))
+    hours = schedule_cache.get_hours(doctor.did, day.date())
+    if not hours[0]:
+        flash(f"Dr. {doctor.doctorname} is not available on {date_str}.", "danger")
+        return redirect(url_for('main.patient'))
+
+    db.session.add(WaitlistEntry(
+        doctor_id=doctor.did, patient_id=current_user.id, date=date_str,
+        start_time=start_time, end_time=end_time, disease=request.form.get('disease'),
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash(f"You are already on Dr. {doctor.doctorname}'s waitlist for {date_str}.", "warning")
+        return redirect(url_for('main.bookings'))
+    flash(f"You are on Dr. {doctor.doctorname}'s waitlist for {date_str}. "
+          "We will book and email you if a slot opens up.", "info")
+    return redirect(url_for('main.bookings'))
+
+
+@main.route('/waitlist/<int:id>/leave', methods=['POST'])
+@login_required
+def leave_waitlist(id):
+    entry = db.get_or_404(WaitlistEntry, id)
+    if entry.patient_id != current_user.id:
+        abort(403)
+    if entry.status == 'waiting':
+        entry.status = 'left'
+        db.session.commit()
+    flash("You have left the waitlist.", "warning")
+    return redirect(url_for('main.bookings'))
+
+
+@main.route('/waitlist/<int:id>/priority', methods=['POST'])
+@login_required
+def set_waitlist_priority(id):
+    """
+    Lets the doctor move urgent patients up their own queue
+    """
+    entry = db.get_or_404(WaitlistEntry, id)
+    doctor = get_current_doctor()
+    if current_user.usertype != 'Doctor' or not doctor or entry.doctor_id != doctor.did:
+        abort(403)
+    entry.priority = request.form.get('priority', 0, type=int)
+    db.session.commit()
+    flash("Waitlist priority updated.", "success")
+    return redirect(url_for('main.bookings'))
+
+
+@main.route('/signup',methods=['POST','GET'])
 def signup():
     if request.method == "POST":
         username=request.form.get('username')
@@ -338,7 +2050,7 @@ def signup():
         if user:
             flash("Email Already Exist","warning")
             return render_template('/signup.html')
-        encpassword=generate_password_hash(password)
+        encpassword=hash_password(password)
 
         new_user = User(
         username=username, 
@@ -356,18 +2068,27 @@ def signup():
 
     return render_template('signup.html')
 
-@app.route('/login',methods=['POST','GET'])
+@main.route('/login',methods=['POST','GET'])
 def login():
     if request.method == "POST":
         email=request.form.get('email')
         password=request.form.get('password')
+        ip=request.remote_addr
+
         user=User.query.filter_by(email=email).first()
 
-        if user and check_password_hash(user.password,password):
+        # Shed brute-force traffic before it costs a hash
+        if login_throttle.is_blocked(email, ip, known=user is not None):
+            flash("Too many failed attempts. Please try again later.","danger")
+            return render_template('login.html'), 429
+
+        if verify_password(user, password):
+            login_throttle.succeeded(email)
             login_user(user)
             flash("Login Success","primary")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
+            login_throttle.failed(email, ip)
             flash("invalid credentials","danger")
             return render_template('login.html')    
 
@@ -377,121 +2098,340 @@ def login():
 
     return render_template('login.html')
 
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash("Logout SuccessFul","warning")
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/doctor/availability', methods=['GET', 'POST'])
+@main.route('/doctor/availability', methods=['GET', 'POST'])
 @login_required
 def doctor_availability():
     # Security Check: Must be a Doctor
     if current_user.usertype != 'Doctor':
         flash("You are not authorized to view this page.", "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     # Find the doctor's profile
-    doctor = Doctors.query.filter_by(email=current_user.email).first()
+    doctor = get_current_doctor()
     if not doctor:
         flash("Doctor profile not found.", "danger")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         # --- Handle the form submission ---
-        days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        
         try:
-            for day in days_of_week:
+            # Load the whole week in one query
+            existing = {
+                row.day_name: (row.id, row.start_time, row.end_time)
+                for row in DoctorAvailability.query.filter_by(doctor_id=doctor.did).all()
+            }
+
+            updates = []
+            inserts = []
+            invalid = []
+            for day in DAYS_OF_WEEK:
                 is_unavailable = request.form.get(f'unavailable_{day}')
                 start_time = request.form.get(f'start_time_{day}')
                 end_time = request.form.get(f'end_time_{day}')
 
-                # Find this day's record in the database
-                availability_record = DoctorAvailability.query.filter_by(
-                    doctor_id=doctor.did,
-                    day_name=day
-                ).first()
-
-                if is_unavailable:
-                    # If "Unavailable" is checked, set times to None
-                    availability_record.start_time = None
-                    availability_record.end_time = None
-                elif start_time and end_time:
-                    # If both times are provided, save them
-                    availability_record.start_time = start_time
-                    availability_record.end_time = end_time
+                if is_unavailable or not (start_time and end_time):
+                    # "Unavailable" checked, or only one/no time given: day off
+                    start_time = None
+                    end_time = None
+                elif not valid_hours(start_time, end_time):
+                    invalid.append(day)
+                    continue
+
+                values = {'start_time': start_time, 'end_time': end_time}
+                if day in existing:
+                    row_id, old_start, old_end = existing[day]
+                    if (old_start, old_end) != (start_time, end_time):
+                        updates.append(dict(values, id=row_id))
+                        # Bulk statements skip ORM events, so audit them here
+                        queue_audit(db.session, 'doctor_availability', row_id, 'update', {
+                            'start_time': [old_start, start_time], 'end_time': [old_end, end_time]
+                        })
                 else:
-                    # If only one time is provided or both are blank, set to None
-                    availability_record.start_time = None
-                    availability_record.end_time = None
-
+                    # Doctors added through /doctors never got default rows
+                    inserts.append(dict(values, day_name=day, doctor_id=doctor.did))
+                    queue_audit(db.session, 'doctor_availability', None, 'insert', inserts[-1])
+
+            if invalid:
+                db.session.rollback()
+                flash(f"Times must be HH:MM with the start before the end ({', '.join(invalid)}). Nothing was saved.", "danger")
+                return redirect(url_for('main.doctor_availability'))
+            if updates:
+                db.session.execute(update(DoctorAvailability), updates)
+            if inserts:
+                db.session.execute(insert(DoctorAvailability), inserts)
+            if updates or inserts:
+                mark_changed(db.session, f'availability:{doctor.did}')
             db.session.commit()
+            schedule_cache.invalidate(doctor.did)
             flash("Availability updated successfully!", "success")
         
         except Exception as e:
             db.session.rollback()
             flash(f"An error occurred: {e}", "danger")
 
-        return redirect(url_for('doctor_availability'))
+        return redirect(url_for('main.doctor_availability'))
 
     # --- GET Request: Show the page ---
-    # Fetch the 7-day schedule for this doctor
-    schedule = DoctorAvailability.query.filter_by(doctor_id=doctor.did).all()
-    
-    # Sort them in the correct weekday order
-    day_order = {"Monday": 1, "Tuesday": 2, "Wednesday": 3, "Thursday": 4, "Friday": 5, "Saturday": 6, "Sunday": 7}
-    schedule.sort(key=lambda x: day_order[x.day_name])
+    # Fetch the 7-day schedule for this doctor, in weekday order.
+    # Missing days are shown as unavailable until the doctor saves.
+    saved = {row.day_name: row for row in DoctorAvailability.query.filter_by(doctor_id=doctor.did).all()}
+    schedule = [
+        saved.get(day) or {'day_name': day, 'start_time': None, 'end_time': None}
+        for day in DAYS_OF_WEEK
+    ]
 
-    return render_template('doctor_manage_availability.html', schedule=schedule)
+    overrides = AvailabilityOverride.query.filter(
+        AvailabilityOverride.doctor_id == doctor.did,
+        AvailabilityOverride.date >= datetime.now().date().isoformat()
+    ).order_by(AvailabilityOverride.date).all()
 
-@app.route('/test')
-def test():
-    try:
+    return render_template('doctor_manage_availability.html', schedule=schedule, overrides=overrides)
+
+
+@main.route('/doctor/availability/override', methods=['POST'])
+@login_required
+def add_availability_override():
+    # Security Check: Must be a Doctor with a profile
+    doctor = get_current_doctor()
+    if not doctor:
+        flash("You are not authorized to perform this action.", "danger")
+        return redirect(url_for('main.index'))
+
+    date_str = request.form.get('override_date')
+    start_time = request.form.get('override_start_time') or None
+    end_time = request.form.get('override_end_time') or None
+    if parse_slot(date_str, '00:00') is None:
+        flash("Invalid date format. Please try again.", "danger")
+        return redirect(url_for('main.doctor_availability'))
+    if request.form.get('override_unavailable') or not (start_time and end_time):
+        start_time = None
+        end_time = None
+    elif not valid_hours(start_time, end_time):
+        flash("Times must be HH:MM with the start before the end.", "danger")
+        return redirect(url_for('main.doctor_availability'))
+
+    # One override per date: saving again replaces it
+    override = AvailabilityOverride.query.filter_by(doctor_id=doctor.did, date=date_str).first()
+    if not override:
+        override = AvailabilityOverride(doctor_id=doctor.did, date=date_str)
+        db.session.add(override)
+    override.start_time = start_time
+    override.end_time = end_time
+    override.reason = request.form.get('override_reason')
+    db.session.commit()
+    schedule_cache.invalidate(doctor.did)
+
+    flash(f"Schedule exception saved for {date_str}.", "success")
+    return redirect(url_for('main.doctor_availability'))
+
+
+@main.route('/doctor/availability/override/delete/<int:id>', methods=['POST'])
+@login_required
+def delete_availability_override(id):
+    override = db.get_or_404(AvailabilityOverride, id)
+    doctor = get_current_doctor()
+    if not doctor or override.doctor_id != doctor.did:
+        flash("You are not authorized to perform this action.", "danger")
+        return redirect(url_for('main.index'))
+
+    db.session.delete(override)
+    db.session.commit()
+    schedule_cache.invalidate(doctor.did)
+
+    flash("Schedule exception removed.", "warning")
+    return redirect(url_for('main.doctor_availability'))
+
+@main.route('/test')
+def test():
+    try:
         Test.query.all()
         return 'My database is Connected'
     except:
         return 'My db is not Connected'
     
 
-@app.route('/details')
-@login_required
-def details():
-    posts=db.engine.execute("SELECT * FROM `trigr`")
-    return render_template('trigers.html',posts=posts)
+# --- RAMMIDOC: full-text search over doctors and patients ---
+# SQLite FTS5 indexes that mirror the user and doctors tables. Triggers keep
+# them in sync on every insert, update and delete, including bulk writes that
+# skip the ORM. On other databases search falls back to ILIKE.
+SEARCH_INDEXES = {
+    # fts table: (source table, key column, indexed columns)
+    'user_fts': ('user', 'id', ['username', 'email']),
+    'doctors_fts': ('doctors', 'did', ['doctorname', 'dept', 'email']),
+}
+SEARCH_PAGE_SIZE = 20
+
+
+def search_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def setup_search():
+    """
+    Creates the FTS5 tables and their sync triggers, and fills any table that
+    was just created from the existing rows
+    """
+    if not search_enabled():
+        return
+    with db.engine.begin() as conn:
+        for fts, (table, key, columns) in SEARCH_INDEXES.items():
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': fts}
+            ).first()
+            cols = ', '.join(columns)
+            new_cols = ', '.join(f'new.{c}' for c in columns)
+            old_cols = ', '.join(f'old.{c}' for c in columns)
+            if not exists:
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE {fts} USING fts5({cols}, content='{table}', content_rowid='{key}')"
+                ))
+                conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+                print(f'[RAMMIDOC] Built search index {fts}')
+            conn.execute(text(
+                f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON "{table}" BEGIN
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new_cols});
+                END"""
+            ))
+            conn.execute(text(
+                f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON "{table}" BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{key}, {old_cols});
+                END"""
+            ))
+            conn.execute(text(
+                f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON "{table}" BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{key}, {old_cols});
+                    INSERT INTO {fts}(rowid, {cols}) VALUES (new.{key}, {new_cols});
+                END"""
+            ))
+
+
+def to_match_query(term):
+    """
+    Turns free text into an FTS5 query where every word is a prefix match,
+    e.g. 'ram card' -> '"ram"* "card"*'. Returns None if nothing is searchable.
+    """
+    words = re.findall(r'\w+', term or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def run_search(model, fts, where_sql, term, limit, offset, fallback_columns):
+    match = to_match_query(term)
+    if match is None:
+        return []
+    if not search_enabled():
+        like = f"%{term}%"
+        return model.query.filter(
+            text(where_sql), or_(*[col.ilike(like) for col in fallback_columns])
+        ).limit(limit).offset(offset).all()
+
+    table, key, _ = SEARCH_INDEXES[fts]
+    statement = text(
+        f"""SELECT "{table}".* FROM {fts} JOIN "{table}" ON "{table}".{key} = {fts}.rowid
+            WHERE {fts} MATCH :match AND {where_sql}
+            ORDER BY {fts}.rank LIMIT :limit OFFSET :offset"""
+    )
+    return db.session.execute(
+        select(model).from_statement(statement),
+        {'match': match, 'limit': limit, 'offset': offset}
+    ).scalars().all()
+
+
+def search_doctors(term, limit=SEARCH_PAGE_SIZE, offset=0):
+    """
+    Doctors ranked by how well their name, department or email match
+    """
+    return run_search(Doctors, 'doctors_fts', '1 = 1', term, limit, offset,
+                      [Doctors.doctorname, Doctors.dept, Doctors.email])
+
+
+def search_patients(term, limit=SEARCH_PAGE_SIZE, offset=0):
+    """
+    Patients ranked by how well their username or email match
+    """
+    return run_search(User, 'user_fts', "\"user\".usertype = 'Patient'", term, limit, offset,
+                      [User.username, User.email])
+
 
+def get_search_page():
+    page = request.values.get('page', 1, type=int) or 1
+    return max(page, 1)
 
-@app.route('/search',methods=['POST','GET'])
+
+@main.route('/search',methods=['POST','GET'])
 @login_required
 def search():
-    if request.method=="POST":
-        query=request.form.get('search')
-        dept=Doctors.query.filter_by(dept=query).first()
-        name=Doctors.query.filter_by(doctorname=query).first()
-        if name:
+    query = request.values.get('search', '')
+    page = get_search_page()
 
-            flash("Doctor is Available","info")
-        else:
+    # Fetch one extra row to know whether there is a next page
+    results = search_doctors(query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE)
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
 
-            flash("Doctor is Not Available","danger")
-    return render_template('index.html')
+    if results:
+        flash("Doctor is Available","info")
+    else:
+        flash("Doctor is Not Available","danger")
+    return render_template('search.html', query=query, results=results, page=page, has_next=has_next)
 
-@app.route('/treatment/add/<int:id>', methods=['GET', 'POST'])
+
+@main.route('/api/search')
+@login_required
+def api_search():
+    """
+    Type-ahead: GET /api/search?q=car&type=doctors|patients&limit=10
+    Patient search is for admins only.
+    """
+    kind = request.args.get('type', 'doctors')
+    limit = max(1, min(request.args.get('limit', 10, type=int) or 10, SEARCH_PAGE_SIZE))
+    term = request.args.get('q', '')
+
+    if kind == 'doctors':
+        results = [
+            {'did': d.did, 'doctorname': d.doctorname, 'dept': d.dept}
+            for d in search_doctors(term, limit)
+        ]
+    elif kind == 'patients':
+        if current_user.usertype != 'Admin':
+            return jsonify(error="Admins only"), 403
+        results = [
+            {'id': u.id, 'username': u.username, 'email': u.email}
+            for u in search_patients(term, limit)
+        ]
+    else:
+        return jsonify(error="type must be doctors or patients"), 400
+    return jsonify(query=term, type=kind, results=results)
+
+
+@main.route('/treatment/add/<int:id>', methods=['GET', 'POST'])
 @login_required
 def add_treatment(id):
     # Security check: Must be a doctor
     if current_user.usertype != 'Doctor':
         flash("You are not authorized to perform this action.", "danger")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
 
-    appointment = Appointment.query.get_or_404(id)
+    appointment = db.get_or_404(Appointment, id, options=with_people())
 
     # Security check: Doctor can only edit their own appointments
-    doctor = Doctors.query.filter_by(email=current_user.email).first()
-    if appointment.doctor_id != doctor.did:
+    doctor = get_current_doctor()
+    if not doctor or appointment.doctor_id != doctor.did:
         flash("This appointment is not assigned to you.", "danger")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
+
+    # One treatment per visit: a second submit would count the visit twice
+    if (appointment.status or 'Booked') != 'Booked' or appointment.treatment:
+        flash("This appointment already has a treatment or is no longer booked.", "warning")
+        return redirect(url_for('main.bookings'))
 
     if request.method == 'POST':
         # Get data from form
@@ -511,40 +2451,398 @@ def add_treatment(id):
         appointment.status = 'Completed'
 
         db.session.add(new_treatment)
-        db.session.commit() # This saves both the new treatment and the status change
+        record_visit(appointment, new_treatment)
+        notify_patient(appointment, 'completed')
+        db.session.commit() # This saves the treatment, the status change and the patient summary
 
         flash("Treatment saved and appointment marked as 'Completed'.", "success")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
 
     # GET Request: Show the form
     return render_template('treatment.html', appointment=appointment, readonly="")
 
-@app.route('/treatment/view/<int:id>')
+@main.route('/treatment/view/<int:id>')
 @login_required
 def view_treatment(id):
-    appointment = Appointment.query.get_or_404(id)
-    treatment = Treatment.query.filter_by(appointment_id=id).first()
+    appointment = db.get_or_404(Appointment, id, options=[selectinload(Appointment.treatment), *with_people()])
+    treatment = appointment.treatment
 
     # Security check: Allow Patient or assigned Doctor
     if current_user.usertype == 'Patient' and appointment.patient_id == current_user.id:
         pass # Allow patient to view
     elif current_user.usertype == 'Doctor':
-        doctor = Doctors.query.filter_by(email=current_user.email).first()
-        if appointment.doctor_id != doctor.did:
+        doctor = get_current_doctor()
+        if not doctor or appointment.doctor_id != doctor.did:
             flash("You are not authorized to view this.", "danger")
-            return redirect(url_for('bookings'))
+            return redirect(url_for('main.bookings'))
     else:
         flash("You are not authorized to view this.", "danger")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
 
     if not treatment:
         flash("Treatment has not been added yet.", "info")
-        return redirect(url_for('bookings'))
+        return redirect(url_for('main.bookings'))
         
     # Render the same template, but with fields disabled
     return render_template('treatment.html', appointment=appointment, treatment=treatment, readonly="readonly")
 
 
+# --- RAMMIDOC: patient history ---
+class PatientSummary(db.Model):
+    """
+    One row per treated patient, kept current by record_visit() so the
+    history page never has to aggregate a long appointment list
+    """
+    __tablename__ = 'patient_summary'
+    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    visit_count = db.Column(db.Integer, nullable=False, default=0)
+    last_visit = db.Column(db.DateTime)
+    last_appointment_id = db.Column(db.Integer)
+    last_doctor_id = db.Column(db.Integer)
+    last_diagnosis = db.Column(db.Text)
+
+
+def record_visit(appointment, treatment):
+    """
+    Counts a completed visit in the patient's summary, in the caller's
+    transaction. The 'last' columns only move forward in time, so notes
+    added late for an older appointment do not replace a newer visit.
+    """
+    newer = "patient_summary.last_visit IS NULL OR excluded.last_visit >= patient_summary.last_visit"
+    db.session.execute(text(
+        f"""INSERT INTO patient_summary (patient_id, visit_count, last_visit, last_appointment_id, last_doctor_id, last_diagnosis)
+            VALUES (:patient_id, 1, :last_visit, :appointment_id, :doctor_id, :diagnosis)
+            ON CONFLICT (patient_id) DO UPDATE SET
+                visit_count = patient_summary.visit_count + 1,
+                last_visit = CASE WHEN {newer} THEN excluded.last_visit ELSE patient_summary.last_visit END,
+                last_appointment_id = CASE WHEN {newer} THEN excluded.last_appointment_id ELSE patient_summary.last_appointment_id END,
+                last_doctor_id = CASE WHEN {newer} THEN excluded.last_doctor_id ELSE patient_summary.last_doctor_id END,
+                last_diagnosis = CASE WHEN {newer} THEN excluded.last_diagnosis ELSE patient_summary.last_diagnosis END"""
+    ).bindparams(bindparam('last_visit', type_=db.DateTime)), {
+        'patient_id': appointment.patient_id,
+        'last_visit': parse_slot(appointment.date, appointment.time),
+        'appointment_id': appointment.id,
+        'doctor_id': appointment.doctor_id,
+        'diagnosis': treatment.diagnosis,
+    })
+
+
+def rebuild_patient_summaries():
+    """
+    Recomputes every summary from the appointment and treatment tables,
+    archived visits included
+    """
+    def visits(appointment, treatment):
+        return select(appointment.c.patient_id, appointment.c.starts_at, appointment.c.id,
+                      appointment.c.doctor_id, treatment.c.diagnosis
+        ).join(treatment, treatment.c.appointment_id == appointment.c.id)
+
+    stmt = visits(Appointment.__table__, Treatment.__table__)
+    if archive_available():
+        archive_metadata.create_all(db.engine)
+        stmt = union_all(stmt, visits(archived_appointment, archived_treatment))
+    both = stmt.subquery()
+    summaries = {}
+    rows = db.session.execute(
+        select(both).order_by(both.c.patient_id, both.c.starts_at, both.c.id)
+        .execution_options(yield_per=1000)
+    )
+    for patient_id, starts_at, appointment_id, doctor_id, diagnosis in rows:
+        summary = summaries.setdefault(patient_id, {'patient_id': patient_id, 'visit_count': 0})
+        summary['visit_count'] += 1
+        summary.update(last_visit=starts_at, last_appointment_id=appointment_id,
+                       last_doctor_id=doctor_id, last_diagnosis=diagnosis)
+
+    db.session.query(PatientSummary).delete()
+    if summaries:
+        db.session.execute(insert(PatientSummary), list(summaries.values()))
+    db.session.commit()
+    return len(summaries)
+
+
+@main.cli.command('rebuild-patient-summaries')
+def rebuild_patient_summaries_command():
+    """Recompute every patient's visit summary from scratch."""
+    print(f'[RAMMIDOC] Rebuilt {rebuild_patient_summaries()} patient summaries')
+
+
+def can_view_history(patient_id):
+    """
+    The patient, an admin, or a doctor who has seen the patient before
+    """
+    if current_user.usertype == 'Admin':
+        return True
+    if current_user.usertype == 'Patient':
+        return current_user.id == patient_id
+    doctor = get_current_doctor()
+    if not doctor:
+        return False
+    tables = [Appointment.__table__] + ([archived_appointment] if archive_available() else [])
+    return any(
+        db.session.scalar(select(table.c.id).where(
+            table.c.patient_id == patient_id, table.c.doctor_id == doctor.did).limit(1)) is not None
+        for table in tables
+    )
+
+
+@main.route('/patient/<int:patient_id>/history')
+@login_required
+def patient_history(patient_id):
+    patient = db.get_or_404(User, patient_id)
+    if patient.usertype != 'Patient' or not can_view_history(patient_id):
+        flash("You are not authorized to view this.", "danger")
+        return redirect(url_for('main.bookings'))
+
+    summary = db.session.get(PatientSummary, patient_id)
+    per_page = get_page_size()
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+    # The archive is only read when asked for
+    archived = request.args.get('archived') == '1' and archive_available()
+    if archived:
+        visits, next_cursor, prev_cursor = paginate_history_with_archive(patient_id, per_page, after, before)
+    else:
+        # Appointments and their treatment notes come back in one joined query per page
+        query = Appointment.query.outerjoin(Appointment.treatment).options(
+            contains_eager(Appointment.treatment)
+        ).filter(Appointment.patient_id == patient_id)
+        visits, next_cursor, prev_cursor = paginate_appointments(query, per_page, after=after, before=before)
+    last_doctor = schedule_cache.get_doctor(summary.last_doctor_id) if summary and summary.last_doctor_id else None
+    return render_template('patient_history.html', patient=patient, summary=summary, last_doctor=last_doctor,
+                           visits=visits, next_cursor=next_cursor, prev_cursor=prev_cursor, per_page=per_page,
+                           archived=archived, archive_available=archive_available())
+
+
+# --- RAMMIDOC: archive of old appointments ---
+# 'flask archive' moves completed and cancelled appointments older than
+# ARCHIVE_AFTER_DAYS, with their treatments, into a second SQLite file that
+# is attached to every connection as the 'archive' schema. The hot tables
+# and their indexes then only hold recent and upcoming visits. Bookings,
+# dashboards and exports read the hot tables only; the history page reads
+# the archive too when asked with ?archived=1.
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_STATUSES = ('Completed', 'Cancelled')
+
+archive_metadata = MetaData()
+
+
+def _archive_table(table):
+    """
+    Copy of a hot table's columns in the archive, without its constraints
+    """
+    return Table(table.name, archive_metadata,
+                 *[db.Column(c.name, c.type, primary_key=c.primary_key) for c in table.columns],
+                 schema='archive')
+
+
+archived_appointment = _archive_table(Appointment.__table__)
+archived_treatment = _archive_table(Treatment.__table__)
+db.Index('ix_archive_appointment_patient_timeline', archived_appointment.c.patient_id,
+         archived_appointment.c.date, archived_appointment.c.time, archived_appointment.c.id)
+db.Index('ix_archive_appointment_doctor', archived_appointment.c.doctor_id)
+db.Index('ix_archive_treatment_appointment_id', archived_treatment.c.appointment_id)
+
+
+def init_archive(app):
+    """
+    Attaches the archive file to each new SQLite connection of the app's
+    engine. ARCHIVE_DATABASE is replaced by the resolved path, or '' when
+    archiving is off.
+    """
+    name = app.config['ARCHIVE_DATABASE']
+    app.config['ARCHIVE_DATABASE'] = ''
+    if name == 'off' or not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    if name:
+        path = os.path.join(app.instance_path, name)
+    else:
+        with app.app_context():
+            main_path = db.engine.url.database
+        if not main_path or main_path == ':memory:' or main_path.startswith('file:'):
+            return
+        path = f'{os.path.splitext(main_path)[0]}-archive.db'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    app.config['ARCHIVE_DATABASE'] = path
+
+    def attach_archive(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('ATTACH DATABASE ? AS archive', (path,))
+        cursor.execute('PRAGMA archive.journal_mode=WAL')
+        cursor.close()
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', attach_archive)
+
+
+def archive_available():
+    return bool(current_app.config['ARCHIVE_DATABASE']) and db.engine.dialect.name == 'sqlite'
+
+
+def has_autoincrement(conn, table):
+    """
+    Whether a SQLite table was created with AUTOINCREMENT, so ids of deleted
+    rows are never reused
+    """
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                       {'name': table.name}).scalar()
+    return sql is not None and 'AUTOINCREMENT' in sql.upper()
+
+
+def rebuild_with_autoincrement(conn, table):
+    """
+    Recreates an existing SQLite table with AUTOINCREMENT, keeping its rows.
+    Indexes are dropped with the old table; upgrade_schema creates them again.
+    """
+    # Foreign keys need the tables they point at in the same MetaData
+    scratch = MetaData()
+    for other in db.metadata.tables.values():
+        other.to_metadata(scratch)
+    rebuilt = table.to_metadata(scratch, name=f'{table.name}_rebuild')
+    existing = {col['name'] for col in inspect(conn).get_columns(table.name)}
+    columns = ', '.join(f'"{c.name}"' for c in table.columns if c.name in existing)
+    conn.execute(CreateTable(rebuilt))
+    conn.execute(text(f'INSERT INTO "{rebuilt.name}" ({columns}) SELECT {columns} FROM "{table.name}"'))
+    conn.execute(text(f'DROP TABLE "{table.name}"'))
+    conn.execute(text(f'ALTER TABLE "{rebuilt.name}" RENAME TO "{table.name}"'))
+
+
+def seed_sequences(conn):
+    """
+    Moves the hot tables' id sequences past every archived id, so rows
+    archived before the tables used AUTOINCREMENT cannot clash with new ones
+    """
+    for hot, archived in ((Appointment.__table__, archived_appointment), (Treatment.__table__, archived_treatment)):
+        floor = conn.execute(select(db.func.max(archived.c.id))).scalar()
+        if not floor:
+            continue
+        params = {'name': hot.name, 'floor': floor}
+        conn.execute(text("UPDATE sqlite_sequence SET seq = :floor WHERE name = :name AND seq < :floor"), params)
+        conn.execute(text(
+            """INSERT INTO sqlite_sequence (name, seq) SELECT :name, :floor
+               WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"""
+        ), params)
+
+
+def copy_to_archive(source, target, condition, identity):
+    """
+    Copies the source rows matching condition into the archive with a plain
+    INSERT. The two files commit separately under WAL, so a crash can leave a
+    batch copied but not yet deleted; on the re-run those rows are skipped,
+    after checking that the archived row with that id is the same row.
+    """
+    def keyed(table, where):
+        return {row[0]: tuple(row[1:]) for row in db.session.execute(
+            select(table.c.id, *[table.c[name] for name in identity]).where(where))}
+
+    rows = keyed(source, condition)
+    if not rows:
+        return
+    archived = keyed(target, target.c.id.in_(list(rows)))
+    clashes = sorted(row_id for row_id, values in archived.items() if values != rows[row_id])
+    if clashes:
+        raise RuntimeError(f'archive.{target.name} already holds different rows with ids {clashes}')
+    new_ids = [row_id for row_id in rows if row_id not in archived]
+    if new_ids:
+        db.session.execute(insert(target).from_select(
+            [c.name for c in source.columns], select(source).where(source.c.id.in_(new_ids))))
+
+
+def archive_appointments(cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Moves completed and cancelled appointments dated before cutoff, with
+    their treatments, into the archive. Each batch is its own transaction,
+    so bookings are never blocked for long. Returns the number moved.
+    """
+    appointment, treatment = Appointment.__table__, Treatment.__table__
+    with db.engine.begin() as conn:
+        missing = [table.name for table in (appointment, treatment) if not has_autoincrement(conn, table)]
+        if missing:
+            raise RuntimeError(f"{', '.join(missing)} can reuse ids; run 'flask init-db' to upgrade the schema first")
+        archive_metadata.create_all(conn)
+        seed_sequences(conn)
+    moved = 0
+    while True:
+        rows = db.session.execute(
+            select(appointment.c.id, appointment.c.patient_id, appointment.c.doctor_id,
+                   appointment.c.status, appointment.c.date)
+            .where(appointment.c.status.in_(ARCHIVE_STATUSES),
+                   appointment.c.date < cutoff.isoformat())
+            .order_by(appointment.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+
+        copy_to_archive(appointment, archived_appointment, appointment.c.id.in_(ids),
+                        ('patient_id', 'doctor_id', 'date', 'time'))
+        copy_to_archive(treatment, archived_treatment, treatment.c.appointment_id.in_(ids), ('appointment_id',))
+        db.session.execute(treatment.delete().where(treatment.c.appointment_id.in_(ids)))
+        db.session.execute(appointment.delete().where(appointment.c.id.in_(ids)))
+
+        # Core deletes skip the ORM hooks, so counters and API versions are
+        # updated here. Patient summaries keep counting archived visits.
+        deltas = {}
+        for row in rows:
+            for key in _appointment_keys(row.doctor_id, row.status, row.date):
+                deltas[key] = deltas.get(key, 0) - 1
+        apply_stat_deltas(db.session, deltas)
+        mark_changed(db.session, *{f'appointments:patient:{row.patient_id}' for row in rows},
+                     *{f'appointments:doctor:{row.doctor_id}' for row in rows})
+        db.session.commit()
+        moved += len(ids)
+    return moved
+
+
+@main.cli.command('archive')
+@click.option('--days', type=int, help='Archive visits older than this many days (default: ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True)
+def archive_command(days, batch_size):
+    """Move old completed and cancelled appointments to the archive database."""
+    if not archive_available():
+        raise click.ClickException('Archiving needs a SQLite database and ARCHIVE_DATABASE set')
+    cutoff = datetime.now().date() - timedelta(days=days if days is not None else current_app.config['ARCHIVE_AFTER_DAYS'])
+    try:
+        moved = archive_appointments(cutoff, batch_size)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    print(f'[RAMMIDOC] Archived {moved} appointments dated before {cutoff}')
+
+
+# Archived rows are plain tuples shaped like what patient_history.html reads
+HistoryVisit = namedtuple('HistoryVisit', ['id', 'date', 'time', 'status', 'disease', 'doctor', 'treatment', 'archived'])
+TreatmentNotes = namedtuple('TreatmentNotes', ['diagnosis', 'prescription', 'notes'])
+
+
+def paginate_history_with_archive(patient_id, per_page, after=None, before=None):
+    """
+    paginate_appointments over one patient's hot and archived appointments
+    together. Rows are HistoryVisit tuples; doctors come from the roster cache.
+    """
+    def history_select(appointment, treatment, archived):
+        return select(
+            appointment.c.id, appointment.c.date, appointment.c.time, appointment.c.status,
+            appointment.c.disease, appointment.c.doctor_id,
+            treatment.c.id.label('treatment_id'), treatment.c.diagnosis, treatment.c.prescription, treatment.c.notes,
+            literal(archived).label('archived')
+        ).select_from(appointment).outerjoin(
+            treatment, treatment.c.appointment_id == appointment.c.id
+        ).where(appointment.c.patient_id == patient_id)
+
+    both = union_all(
+        history_select(Appointment.__table__, Treatment.__table__, False),
+        history_select(archived_appointment, archived_treatment, True)
+    ).subquery()
+    rows, next_cursor, prev_cursor = paginate_appointments(
+        db.session.query(both), per_page, after, before, sort_columns=(both.c.date, both.c.time, both.c.id))
+    visits = [
+        HistoryVisit(row.id, row.date, row.time, row.status, row.disease, schedule_cache.get_doctor(row.doctor_id),
+                     TreatmentNotes(row.diagnosis, row.prescription, row.notes) if row.treatment_id else None,
+                     bool(row.archived))
+        for row in rows
+    ]
+    return visits, next_cursor, prev_cursor
+
+
 def admin_required(f):
     """
     Decorator to ensure a user is an Admin
@@ -553,63 +2851,63 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if not current_user.is_authenticated or current_user.usertype != 'Admin':
             flash("You must be an Admin to view this page.", "danger")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         return f(*args, **kwargs)
     return decorated_function
 
 
-@app.route('/admin/patients', methods=['GET', 'POST'])
+@main.route('/admin/patients', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def admin_manage_patients():
-    if request.method == 'POST':
-        # Handle search
-        query = request.form.get('search_query', '')
-        search_term = f"%{query}%"
-        # Search by username or email, case-insensitive
-        patients = User.query.filter(
-            User.usertype == 'Patient',
-            or_(
-                User.username.ilike(search_term),
-                User.email.ilike(search_term)
-            )
-        ).all()
+    query = request.values.get('search_query', '')
+    page = get_search_page()
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+
+    if query:
+        # Handle search (ranked full-text match on username or email)
+        patients = search_patients(query, SEARCH_PAGE_SIZE + 1, offset)
         page_title = f"Search Results for '{query}'"
     else:
-        # GET request: Show all patients
-        patients = User.query.filter_by(usertype='Patient').all()
+        # Show all patients, one page at a time
+        patients = User.query.filter_by(usertype='Patient').order_by(User.id).limit(SEARCH_PAGE_SIZE + 1).offset(offset).all()
         page_title = "Manage All Patients"
+
+    has_next = len(patients) > SEARCH_PAGE_SIZE
+    patients = patients[:SEARCH_PAGE_SIZE]
         
-    return render_template('admin_manage_patients.html', patients=patients, title=page_title)
+    return render_template('admin_manage_patients.html', patients=patients, title=page_title,
+                           search_query=query, page=page, has_next=has_next)
 
 
-@app.route('/admin/patients/delete/<int:id>')
+@main.route('/admin/patients/delete/<int:id>')
 @login_required
 @admin_required
 def admin_delete_patient(id):
-    patient_to_delete = User.query.get_or_404(id)
+    patient_to_delete = db.get_or_404(User, id)
 
     # Security check: Make sure this is a patient
     if patient_to_delete.usertype != 'Patient':
         flash("This user is not a patient.", "danger")
-        return redirect(url_for('admin_manage_patients'))
+        return redirect(url_for('main.admin_manage_patients'))
 
     # --- Dependency Check (CRITICAL) ---
     # Before deleting a patient, we must check if they have appointments.
     appointments = Appointment.query.filter_by(patient_id=id).first()
     if appointments:
         flash("Cannot delete patient. They have existing appointments in the system. Please cancel appointments first.", "danger")
-        return redirect(url_for('admin_manage_patients'))
+        return redirect(url_for('main.admin_manage_patients'))
         
     # If no appointments, proceed with deletion
+    WaitlistEntry.query.filter_by(patient_id=id).delete()
     db.session.delete(patient_to_delete)
     db.session.commit()
     
     flash("Patient deleted successfully.", "success")
-    return redirect(url_for('admin_manage_patients'))
+    return redirect(url_for('main.admin_manage_patients'))
 
 
-@app.route('/admin/doctors', methods=['GET', 'POST'])
+@main.route('/admin/doctors', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def admin_manage_doctors():
@@ -626,13 +2924,13 @@ def admin_manage_doctors():
         
         if user_exists or doctor_exists:
             flash("A user with this email already exists.", "danger")
-            return redirect(url_for('admin_manage_doctors'))
+            return redirect(url_for('main.admin_manage_doctors'))
 
         # 1. Create the User login for the doctor
         new_user_login = User(
             username=name,
             email=email,
-            password=generate_password_hash(password),
+            password=hash_password(password),
             usertype='Doctor'
         )
         db.session.add(new_user_login)
@@ -646,35 +2944,36 @@ def admin_manage_doctors():
         db.session.add(new_doctor_profile)
         
         # --- NEW LOGIC: Create default availability ---
-        # We must commit here so new_doctor_profile gets its 'did' (ID)
-        db.session.commit()
+        # Flush (not commit) so new_doctor_profile gets its 'did' (ID)
+        db.session.flush()
         
-        days_of_week = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        for day in days_of_week:
-            default_availability = DoctorAvailability(
+        db.session.add_all([
+            DoctorAvailability(
                 day_name=day,
                 start_time=None, # None means unavailable
                 end_time=None,
                 doctor_id=new_doctor_profile.did
             )
-            db.session.add(default_availability)
+            for day in DAYS_OF_WEEK
+        ])
             
-        # Commit the new availability records
+        # One commit for the login, the profile and the week of availability
         db.session.commit()
+        schedule_cache.invalidate()
         # --- END OF NEW LOGIC ---
         
         flash("Doctor profile and default schedule created successfully.", "success")
-        return redirect(url_for('admin_manage_doctors'))
+        return redirect(url_for('main.admin_manage_doctors'))
 
     # GET request: Show the list of doctors
     all_doctors = Doctors.query.all()
     return render_template('admin_manage_doctors.html', doctors=all_doctors)
 
-@app.route('/admin/doctors/edit/<int:did>', methods=['GET', 'POST'])
+@main.route('/admin/doctors/edit/<int:did>', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def admin_edit_doctor(did):
-    doctor = Doctors.query.get_or_404(did)
+    doctor = db.get_or_404(Doctors, did)
     user = User.query.filter_by(email=doctor.email).first()
 
     if request.method == 'POST':
@@ -691,21 +2990,22 @@ def admin_edit_doctor(did):
             # Optionally reset password
             new_password = request.form.get('password')
             if new_password:
-                user.password = generate_password_hash(new_password)
+                user.password = hash_password(new_password)
                 
         db.session.commit()
+        schedule_cache.invalidate()
         flash("Doctor profile updated successfully.", "success")
-        return redirect(url_for('admin_manage_doctors'))
+        return redirect(url_for('main.admin_manage_doctors'))
 
     # GET request: Show the edit form
     return render_template('admin_edit_doctor.html', doctor=doctor)
 
 
-@app.route('/admin/doctors/delete/<int:did>')
+@main.route('/admin/doctors/delete/<int:did>')
 @login_required
 @admin_required
 def admin_delete_doctor(did):
-    doctor = Doctors.query.get_or_404(did)
+    doctor = db.get_or_404(Doctors, did)
     user = User.query.filter_by(email=doctor.email).first()
 
     # --- Important: Check for dependencies ---
@@ -714,16 +3014,107 @@ def admin_delete_doctor(did):
     appointments = Appointment.query.filter_by(doctor_id=did).first()
     if appointments:
         flash("Cannot delete doctor. They are assigned to one or more appointments. Please re-assign appointments first.", "danger")
-        return redirect(url_for('admin_manage_doctors'))
+        return redirect(url_for('main.admin_manage_doctors'))
 
     # If no appointments, proceed with deletion
+    WaitlistEntry.query.filter_by(doctor_id=did).delete()
+    AvailabilityOverride.query.filter_by(doctor_id=did).delete()
     if user:
         db.session.delete(user) # Delete the login
     db.session.delete(doctor)   # Delete the profile
     db.session.commit()
+    schedule_cache.invalidate()
     
     flash("Doctor profile and login deleted successfully.", "success")
-    return redirect(url_for('admin_manage_doctors'))
+    return redirect(url_for('main.admin_manage_doctors'))
+
+
+# --- RAMMIDOC: in-place schema upgrades for existing databases ---
+# db.create_all() only creates missing tables, so columns and indexes added to
+# existing models are applied here. Every step is safe to run more than once.
+def find_double_bookings(conn):
+    """
+    Live appointments that share a doctor, date and time, as
+    [(doctor_id, date, time, [appointment ids]), ...]
+    """
+    appointment = Appointment.__table__
+    live = appointment.c.status != 'Cancelled'
+    slot = (appointment.c.doctor_id, appointment.c.date, appointment.c.time)
+    shared = select(*slot).where(live).group_by(*slot).having(db.func.count() > 1)
+    rows = conn.execute(
+        select(*slot, appointment.c.id).where(live, tuple_(*slot).in_(shared))
+        .order_by(appointment.c.date, appointment.c.time, appointment.c.doctor_id, appointment.c.id)
+    )
+    clashes = {}
+    for doctor_id, date, time_str, appointment_id in rows:
+        clashes.setdefault((doctor_id, date, time_str), []).append(appointment_id)
+    return [key + (ids,) for key, ids in clashes.items()]
+
+
+def upgrade_schema():
+    inspector = inspect(db.engine)
+    appointment_columns = {col['name'] for col in inspector.get_columns('appointment')}
+
+    # Booking relies on uq_appointment_active_slot to reject double bookings,
+    # so stop before changing anything if existing rows would break it
+    if 'uq_appointment_active_slot' not in {ix['name'] for ix in inspector.get_indexes('appointment')}:
+        with db.engine.connect() as conn:
+            clashes = find_double_bookings(conn)
+        if clashes:
+            lines = '\n'.join(f'  doctor {doctor_id} on {date} at {time_str}: appointments {ids}'
+                              for doctor_id, date, time_str, ids in clashes)
+            raise RuntimeError('Cancel or move these double-booked appointments, then run the upgrade again:\n' + lines)
+
+    with db.engine.begin() as conn:
+        if 'starts_at' not in appointment_columns:
+            conn.execute(text("ALTER TABLE appointment ADD COLUMN starts_at DATETIME"))
+            print('[RAMMIDOC] Added appointment.starts_at')
+
+        outbox_columns = {col['name'] for col in inspector.get_columns('outbox_message')}
+        if 'claim_token' not in outbox_columns:
+            conn.execute(text("ALTER TABLE outbox_message ADD COLUMN claim_token VARCHAR(32)"))
+            print('[RAMMIDOC] Added outbox_message.claim_token')
+
+        if db.engine.dialect.name == 'sqlite':
+            # Older databases can hand out the ids of archived rows again
+            for table in (Appointment.__table__, Treatment.__table__):
+                if not has_autoincrement(conn, table):
+                    rebuild_with_autoincrement(conn, table)
+                    print(f'[RAMMIDOC] Rebuilt {table.name} with AUTOINCREMENT')
+
+        # Backfill the typed column from the old string columns
+        rows = conn.execute(text(
+            "SELECT id, date, time FROM appointment WHERE starts_at IS NULL"
+        )).fetchall()
+        for row in rows:
+            starts_at = parse_slot(row.date, row.time)
+            if starts_at:
+                conn.execute(
+                    Appointment.__table__.update().where(Appointment.id == row.id).values(starts_at=starts_at)
+                )
+
+        for index in Treatment.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+        if archive_available():
+            archive_metadata.create_all(conn)
+            seed_sequences(conn)
+
+        # Replaced by ix_appointment_doctor_starts_at, which the range queries use
+        if 'ix_appointment_starts_at' in {ix['name'] for ix in inspect(conn).get_indexes('appointment')}:
+            conn.execute(text("DROP INDEX ix_appointment_starts_at"))
+            print('[RAMMIDOC] Dropped index ix_appointment_starts_at')
+
+        for index in Appointment.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+    setup_search()
+
+    # First run with the statistics table: fill it from the existing rows
+    if not StatCounter.query.first():
+        rebuild_stats()
+    if not PatientSummary.query.first() and Treatment.query.first():
+        rebuild_patient_summaries()
 
 
 # --- RAMMIDOC: ensure admin user exists programmatically ---
@@ -736,7 +3127,7 @@ def ensure_admin():
         admin = None
     if not admin:
         try:
-            admin = User(username='admin', usertype='Admin', email='admin@rammidoc.local', password=generate_password_hash('Admin@123'))
+            admin = User(username='admin', usertype='Admin', email='admin@rammidoc.local', password=hash_password('Admin@123'))
             db.session.add(admin)
             db.session.commit()
             print('[RAMMIDOC] Created default admin: admin@rammidoc.local / Admin@123')
@@ -745,37 +3136,1121 @@ def ensure_admin():
 
 
 
-@app.route('/admin/dashboard')
+# --- RAMMIDOC: keyset pagination helpers for appointment lists ---
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(appointment):
+    """
+    Turns an appointment's (date, time, id) sort key into an opaque URL token
+    """
+    raw = f"{appointment.date}|{appointment.time}|{appointment.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Reverses encode_cursor. Returns None for a missing or tampered token.
+    """
+    if not token:
+        return None
+    try:
+        date_str, time_str, app_id = base64.urlsafe_b64decode(token.encode()).decode().split('|')
+        return (date_str, time_str, int(app_id))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def get_page_size():
+    try:
+        per_page = int(request.args.get('per_page', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        per_page = DEFAULT_PAGE_SIZE
+    return max(1, min(per_page, MAX_PAGE_SIZE))
+
+
+def paginate_appointments(query, per_page, after=None, before=None, sort_columns=None):
+    """
+    Keyset pagination over appointments, newest first.
+
+    'after' continues to older rows, 'before' goes back to newer rows. Both are
+    cursors from encode_cursor. Patient and doctor are joined into the same
+    SELECT so the template does not lazy-load them row by row; the doctors'
+    weekly schedules are not needed for a list and are skipped.
+    Queries over other rows (such as a union with the archive) pass their
+    own (date, time, id) sort_columns.
+    Returns (rows, next_cursor, prev_cursor).
+    """
+    if sort_columns is None:
+        sort_columns = (Appointment.date, Appointment.time, Appointment.id)
+        query = query.options(*with_people())
+    sort_key = tuple_(*sort_columns)
+
+    if before:
+        # Walk backwards (ascending), then flip so the page still reads newest first
+        rows = query.filter(sort_key > before).order_by(
+            *[column.asc() for column in sort_columns]
+        ).limit(per_page + 1).all()
+        has_more_newer = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_more_older = True
+    else:
+        if after:
+            query = query.filter(sort_key < after)
+        rows = query.order_by(
+            *[column.desc() for column in sort_columns]
+        ).limit(per_page + 1).all()
+        has_more_older = len(rows) > per_page
+        rows = rows[:per_page]
+        has_more_newer = after is not None
+
+    next_cursor = encode_cursor(rows[-1]) if rows and has_more_older else None
+    prev_cursor = encode_cursor(rows[0]) if rows and has_more_newer else None
+    return rows, next_cursor, prev_cursor
+
+
+@main.route('/admin/dashboard')
 @login_required
 @admin_required
 def admin_dashboard():
-    # --- Get Statistics (Core Requirement) ---
-    stats = {
-        'doctors': Doctors.query.count(),
-        'patients': User.query.filter_by(usertype='Patient').count(),
-        'appointments': Appointment.query.count()
-    }
+    # --- Get Statistics (Core Requirement), maintained incrementally ---
+    stats = get_stats()
+    # Busiest doctors and the last two weeks of bookings, for the summary tables
+    doctor_names = {str(d.did): d.doctorname for d in schedule_cache.get_roster()}
+    top_doctors = sorted(stats['by_doctor'].items(), key=lambda item: item[1], reverse=True)[:10]
+    top_doctors = [(doctor_names.get(did, f'#{did}'), count) for did, count in top_doctors]
+    today = datetime.now().date()
+    first_day = (today - timedelta(days=13)).isoformat()
+    recent_days = sorted(((day, count) for day, count in stats['by_day'].items()
+                          if first_day <= day <= today.isoformat()), reverse=True)
     
-    # --- Get All Appointments (Core Requirement) ---
-    all_appointments = Appointment.query.order_by(Appointment.date.desc(), Appointment.time.desc()).all()
+    # --- Get one page of Appointments (Core Requirement) ---
+    per_page = get_page_size()
+    all_appointments, next_cursor, prev_cursor = paginate_appointments(
+        Appointment.query,
+        per_page,
+        after=decode_cursor(request.args.get('after')),
+        before=decode_cursor(request.args.get('before'))
+    )
     
-    return render_template('admin_dashboard.html', stats=stats, all_appointments=all_appointments)
+    return render_template('admin_dashboard.html', stats=stats, all_appointments=all_appointments,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor, per_page=per_page,
+                           top_doctors=top_doctors, recent_days=recent_days)
+
+
+@main.route('/details')
+@login_required
+@admin_required
+def details():
+    # Filters come from the query string; all are optional
+    filters = {key: request.args.get(key, '') for key in ('table', 'action', 'actor', 'row', 'since', 'until')}
+    query = AuditLog.query
+    if filters['table']:
+        query = query.filter(AuditLog.table_name == filters['table'])
+    if filters['action']:
+        query = query.filter(AuditLog.action == filters['action'])
+    if filters['actor'].isdigit():
+        query = query.filter(AuditLog.actor_id == int(filters['actor']))
+    if filters['row'].isdigit():
+        query = query.filter(AuditLog.row_id == int(filters['row']))
+    # Date bounds also narrow the period, so whole months are skipped via its index
+    since = parse_slot(filters['since'], '00:00')
+    until = parse_slot(filters['until'], '00:00')
+    if since:
+        query = query.filter(AuditLog.period >= since.strftime('%Y-%m'), AuditLog.created_at >= since)
+    if until:
+        query = query.filter(AuditLog.period <= until.strftime('%Y-%m'), AuditLog.created_at < until + timedelta(days=1))
+
+    # Keyset pagination on id, newest first
+    before_id = request.args.get('before_id', type=int)
+    if before_id:
+        query = query.filter(AuditLog.id < before_id)
+    posts = query.order_by(AuditLog.id.desc()).limit(AUDIT_PAGE_SIZE + 1).all()
+    next_id = posts[AUDIT_PAGE_SIZE - 1].id if len(posts) > AUDIT_PAGE_SIZE else None
+    posts = posts[:AUDIT_PAGE_SIZE]
+
+    return render_template('trigers.html', posts=posts, filters=filters, next_id=next_id,
+                           tables=sorted(AUDITED_MODELS.values()))
+
+
+# --- RAMMIDOC: streaming appointment export ---
+# Rows are read with yield_per (a server-side cursor where the driver has
+# one) and written out as they arrive, so memory use does not grow with the
+# size of the export.
+EXPORT_COLUMNS = [
+    'appointment_id', 'date', 'time', 'status', 'disease',
+    'patient_id', 'patient_name', 'patient_email',
+    'doctor_id', 'doctor_name', 'dept',
+    'diagnosis', 'prescription', 'notes',
+]
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_query(start=None, end=None, dept=None):
+    patient = User.__table__
+    doctor = Doctors.__table__
+    treatment = Treatment.__table__
+    stmt = select(
+        Appointment.id, Appointment.date, Appointment.time, Appointment.status, Appointment.disease,
+        patient.c.id, patient.c.username, patient.c.email,
+        doctor.c.did, doctor.c.doctorname, doctor.c.dept,
+        treatment.c.diagnosis, treatment.c.prescription, treatment.c.notes,
+    ).select_from(Appointment.__table__).join(
+        patient, patient.c.id == Appointment.patient_id
+    ).join(
+        doctor, doctor.c.did == Appointment.doctor_id
+    ).outerjoin(
+        treatment, treatment.c.appointment_id == Appointment.id
+    )
+    if start:
+        stmt = stmt.where(Appointment.date >= start)
+    if end:
+        stmt = stmt.where(Appointment.date <= end)
+    if dept:
+        stmt = stmt.where(doctor.c.dept == dept)
+    return stmt.order_by(Appointment.date, Appointment.time, Appointment.id)
+
+
+def iter_export(fmt, start=None, end=None, dept=None):
+    """
+    Yields the export as text chunks, one chunk per batch of rows
+    """
+    result = db.session.execute(
+        export_query(start, end, dept).execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE)
+    )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(EXPORT_COLUMNS)
+
+    for batch in result.partitions():
+        for row in batch:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if fmt == 'csv' and buffer.tell():
+        yield buffer.getvalue()
+
+
+def get_export_filters(values):
+    """
+    Reads start/end (YYYY-MM-DD) and dept; returns None for a malformed date
+    """
+    start, end = values.get('start') or None, values.get('end') or None
+    for value in (start, end):
+        if value and parse_slot(value, '00:00') is None:
+            return None
+    return {'start': start, 'end': end, 'dept': values.get('dept') or None}
+
+
+@main.route('/admin/export/appointments.<fmt>')
+@login_required
+@admin_required
+def export_appointments(fmt):
+    """
+    GET /admin/export/appointments.csv?start=2025-01-01&end=2025-12-31&dept=Cardiology
+    (or .ndjson)
+    """
+    if fmt not in ('csv', 'ndjson'):
+        abort(404)
+    filters = get_export_filters(request.args)
+    if filters is None:
+        flash("Invalid date format. Please try again.", "danger")
+        return redirect(url_for('main.admin_dashboard'))
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(
+        stream_with_context(iter_export(fmt, **filters)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=appointments.{fmt}'}
+    )
+
+
+@main.cli.command('export-appointments')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv', show_default=True)
+@click.option('--start', help='First date to include (YYYY-MM-DD).')
+@click.option('--end', help='Last date to include (YYYY-MM-DD).')
+@click.option('--dept', help='Only this department.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write (default: stdout).')
+def export_appointments_command(fmt, start, end, dept, output):
+    """Stream appointments with patient, doctor and treatment data."""
+    filters = get_export_filters({'start': start, 'end': end, 'dept': dept})
+    if filters is None:
+        raise click.BadParameter('dates must be YYYY-MM-DD')
+    for chunk in iter_export(fmt, **filters):
+        output.write(chunk)
+
+
+# --- RAMMIDOC: bulk import of doctors, patients and schedules ---
+# Records are validated and written in chunks: one duplicate-email query, a
+# few executemany INSERT/UPDATEs and one commit per chunk. Bulk statements
+# skip ORM events, so counters and audit entries are added here directly.
+#
+#   doctors:   doctorname, email, dept [, password | password_hash]
+#   patients:  username, email [, password | password_hash]
+#   schedules: email (of the doctor), day_name, start_time, end_time
+#
+# Accounts imported without a password get an unusable one and cannot log
+# in until an admin sets it.
+IMPORT_KINDS = ('doctors', 'patients', 'schedules')
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_ERRORS = 100
+UNUSABLE_PASSWORD = '!'
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+$')
+
+
+class ImportReport:
+    def __init__(self, kind, dry_run):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.read = 0
+        self.written = 0      # rows inserted or updated (would be, on a dry run)
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []      # (record number, message), capped at IMPORT_MAX_ERRORS
+        self.seen = set()     # emails from earlier chunks, so dry runs catch repeats too
+
+    def error(self, number, message):
+        self.invalid += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append((number, message))
+
+    def summary(self):
+        verb = 'would write' if self.dry_run else 'wrote'
+        return (f"{self.kind}: read {self.read}, {verb} {self.written}, "
+                f"skipped {self.duplicates} duplicates, {self.invalid} invalid")
+
+
+def read_records(stream, fmt):
+    """
+    Yields dicts from a CSV (header row) or JSON (list of objects) text stream
+    """
+    if fmt == 'json':
+        data = json.load(stream)
+        if not isinstance(data, list):
+            raise ValueError("a JSON import must be a list of objects")
+        yield from data
+    else:
+        yield from csv.DictReader(stream)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _clean(record, *fields):
+    return [str(record.get(field) or '').strip() for field in fields]
+
+
+def _import_password(record):
+    if record.get('password_hash'):
+        return record['password_hash']
+    if record.get('password'):
+        return hash_password(record['password'])
+    return UNUSABLE_PASSWORD
+
+
+def _import_accounts(kind, chunk, report):
+    """
+    Validates and writes one chunk of doctors or patients
+    """
+    name_field = 'doctorname' if kind == 'doctors' else 'username'
+    valid = {}
+    for number, record in chunk:
+        name, email, dept = _clean(record, name_field, 'email', 'dept')
+        email = email.lower()
+        if not name or not EMAIL_PATTERN.match(email):
+            report.error(number, f"{name_field} and a valid email are required")
+        elif kind == 'doctors' and not dept:
+            report.error(number, "dept is required")
+        elif email in valid or email in report.seen:
+            report.duplicates += 1
+        else:
+            valid[email] = (number, record, name, dept)
+    report.seen.update(valid)
+
+    # One query for every email in the chunk that is already taken (in any case)
+    taken = set(db.session.scalars(
+        select(db.func.lower(User.email)).where(db.func.lower(User.email).in_(list(valid)))))
+    if kind == 'doctors':
+        taken |= set(db.session.scalars(
+            select(db.func.lower(Doctors.email)).where(db.func.lower(Doctors.email).in_(list(valid)))))
+    for email in taken:
+        if valid.pop(email, None):
+            report.duplicates += 1
+
+    report.written += len(valid)
+    if report.dry_run or not valid:
+        return
+
+    users = [
+        {'username': name, 'email': email, 'password': _import_password(record),
+         'usertype': 'Doctor' if kind == 'doctors' else 'Patient'}
+        for email, (number, record, name, dept) in valid.items()
+    ]
+    user_ids = db.session.execute(insert(User).returning(User.id, sort_by_parameter_order=True), users).scalars().all()
+    for user_id, row in zip(user_ids, users):
+        queue_audit(db.session, 'user', user_id, 'insert', {k: v for k, v in row.items() if k != 'password'})
+
+    if kind == 'doctors':
+        profiles = [
+            {'doctorname': name, 'email': email, 'dept': dept}
+            for email, (number, record, name, dept) in valid.items()
+        ]
+        doctor_ids = db.session.execute(
+            insert(Doctors).returning(Doctors.did, sort_by_parameter_order=True), profiles
+        ).scalars().all()
+        db.session.execute(insert(DoctorAvailability), [
+            {'doctor_id': did, 'day_name': day, 'start_time': None, 'end_time': None}
+            for did in doctor_ids for day in DAYS_OF_WEEK
+        ])
+        apply_stat_deltas(db.session, {('total', 'doctors'): len(doctor_ids)})
+        mark_changed(db.session, 'doctors')
+    else:
+        apply_stat_deltas(db.session, {('total', 'patients'): len(user_ids)})
+
+
+def _import_schedules(chunk, report):
+    """
+    Validates and upserts one chunk of weekly schedule rows
+    """
+    rows = []
+    for number, record in chunk:
+        email, day, start_time, end_time = _clean(record, 'email', 'day_name', 'start_time', 'end_time')
+        email = email.lower()
+        day = day.capitalize()
+        if day not in DAYS_OF_WEEK:
+            report.error(number, f"day_name must be one of {', '.join(DAYS_OF_WEEK)}")
+        elif (start_time or end_time) and not valid_hours(start_time, end_time):
+            report.error(number, "start_time and end_time must be HH:MM with start before end, or both blank")
+        else:
+            rows.append((number, email, day, start_time or None, end_time or None))
+
+    # Resolve doctors and load their current rows: two queries per chunk
+    doctor_ids = dict(db.session.execute(
+        select(db.func.lower(Doctors.email), Doctors.did)
+        .where(db.func.lower(Doctors.email).in_({row[1] for row in rows}))
+    ).all())
+    existing = {
+        (doctor_id, day_name): row_id
+        for row_id, doctor_id, day_name in db.session.execute(
+            select(DoctorAvailability.id, DoctorAvailability.doctor_id, DoctorAvailability.day_name)
+            .where(DoctorAvailability.doctor_id.in_(list(doctor_ids.values())))
+        ).all()
+    }
+
+    updates = {}
+    inserts = {}
+    for number, email, day, start_time, end_time in rows:
+        doctor_id = doctor_ids.get(email)
+        if doctor_id is None:
+            report.error(number, f"no doctor with email {email}")
+            continue
+        values = {'start_time': start_time, 'end_time': end_time}
+        if (doctor_id, day) in existing:
+            row_id = existing[(doctor_id, day)]
+            updates[row_id] = dict(values, id=row_id)
+        else:
+            # A later row for the same doctor and day wins
+            inserts[(doctor_id, day)] = dict(values, doctor_id=doctor_id, day_name=day)
+
+    report.written += len(updates) + len(inserts)
+    if report.dry_run:
+        return
+    if updates:
+        db.session.execute(update(DoctorAvailability), list(updates.values()))
+        for row_id, values in updates.items():
+            queue_audit(db.session, 'doctor_availability', row_id, 'update', values)
+    if inserts:
+        db.session.execute(insert(DoctorAvailability), list(inserts.values()))
+        for values in inserts.values():
+            queue_audit(db.session, 'doctor_availability', None, 'insert', values)
+    if updates or inserts:
+        mark_changed(db.session, *(f'availability:{doctor_id}' for doctor_id in doctor_ids.values()))
+
+
+def import_records(kind, records, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Imports an iterable of dicts, one transaction per chunk. On a dry run every
+    check (including duplicate emails) runs but nothing is written.
+    Returns an ImportReport.
+    """
+    report = ImportReport(kind, dry_run)
+    for chunk in chunked(enumerate(records, start=1), chunk_size):
+        report.read += len(chunk)
+        for number, record in chunk:
+            if not isinstance(record, dict):
+                report.error(number, "each record must be an object")
+        chunk = [(number, record) for number, record in chunk if isinstance(record, dict)]
+        if kind == 'schedules':
+            _import_schedules(chunk, report)
+        else:
+            _import_accounts(kind, chunk, report)
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    if not dry_run:
+        schedule_cache.invalidate()
+    return report
+
+
+@main.route('/admin/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_import():
+    report = None
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        upload = request.files.get('file')
+        if kind not in IMPORT_KINDS or not upload or not upload.filename:
+            flash("Choose what to import and a CSV or JSON file.", "danger")
+            return redirect(url_for('main.admin_import'))
+
+        fmt = 'json' if upload.filename.lower().endswith('.json') else 'csv'
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        try:
+            report = import_records(kind, read_records(stream, fmt), dry_run=bool(request.form.get('dry_run')))
+        except (ValueError, csv.Error) as e:
+            db.session.rollback()
+            flash(f"Could not read the file: {e}", "danger")
+            return redirect(url_for('main.admin_import'))
+        flash(report.summary(), "warning" if report.invalid else "success")
+
+    return render_template('admin_import.html', report=report, kinds=IMPORT_KINDS)
+
+
+@main.cli.command('import')
+@click.argument('kind', type=click.Choice(IMPORT_KINDS))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing.')
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_command(kind, path, dry_run, chunk_size):
+    """Bulk import doctors, patients or schedules from a CSV or JSON file."""
+    fmt = 'json' if path.lower().endswith('.json') else 'csv'
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        try:
+            report = import_records(kind, read_records(stream, fmt), dry_run=dry_run, chunk_size=chunk_size)
+        except (ValueError, csv.Error) as e:
+            db.session.rollback()
+            raise click.ClickException(f"Could not read the file: {e}")
+    for number, message in report.errors:
+        print(f'  record {number}: {message}')
+    if report.invalid > len(report.errors):
+        print(f'  ... and {report.invalid - len(report.errors)} more')
+    print(f'[RAMMIDOC] {report.summary()}')
 
 
-@app.route('/admin/appointments')
+@main.route('/admin/appointments')
 @login_required
 @admin_required
 def admin_appointments():
     # This route just shows the full list of appointments
     # For now, we'll just redirect to the dashboard which already has the list
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('main.admin_dashboard'))
+
+
+# --- RAMMIDOC: static assets ---
+# 'flask build-assets' writes optimised, content-hashed copies of static/ to
+# static/dist with a manifest.json. Templates link them through asset_url(),
+# which falls back to the plain static file before a build. Hashed names
+# change whenever the content does, so they are cached for a year.
+# CSS url() references are not rewritten; none of ours point at local files.
+ASSET_DIR = 'dist'
+ASSET_MAX_AGE = 365 * 24 * 3600
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt'}
+_asset_manifest = {}
+
+
+def _fingerprint(path, data, extension=None):
+    """
+    'images/doc.jpg' -> 'images/doc.<hash>.jpg', the hash taken from data
+    """
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{extension or ext}"
+
+
+def _optimise_image(data, extension, max_width):
+    """
+    Returns (image bytes, webp bytes or None). Without Pillow the original is kept.
+    """
+    if Image is None:
+        return data, None
+    image = Image.open(io.BytesIO(data))
+    resized = image.width > max_width
+    if resized:
+        image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if extension == '.png':
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(out, 'JPEG', quality=82, optimize=True, progressive=True)
+    webp = io.BytesIO()
+    image.save(webp, 'WEBP', quality=80, method=6)
+    optimised = out.getvalue() if resized or out.tell() < len(data) else data
+    return optimised, webp.getvalue()
+
+
+def _write_asset(root, path, data):
+    target = os.path.join(root, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(data)
 
 
-# This is the standard way to run a Flask app
+def build_assets(static_folder, max_width):
+    """
+    Rebuilds static/dist and its manifest: {source path: {'file': ..., 'webp': ...}}.
+    Returns (manifest, source bytes, built bytes) for the report.
+    """
+    root = os.path.join(static_folder, ASSET_DIR)
+    shutil.rmtree(root, ignore_errors=True)
+    manifest, before, after = {}, 0, 0
+    for folder, subfolders, files in os.walk(static_folder):
+        subfolders[:] = [name for name in subfolders if os.path.join(folder, name) != root]
+        for name in sorted(files):
+            path = os.path.relpath(os.path.join(folder, name), static_folder).replace(os.sep, '/')
+            extension = os.path.splitext(name)[1].lower()
+            with open(os.path.join(folder, name), 'rb') as f:
+                data = f.read()
+            before += len(data)
+
+            entry = {}
+            if extension in IMAGE_EXTENSIONS:
+                data, webp = _optimise_image(data, extension, max_width)
+                if webp and len(webp) < len(data):
+                    entry['webp'] = _fingerprint(path, webp, '.webp')
+                    _write_asset(root, entry['webp'], webp)
+            entry['file'] = _fingerprint(path, data)
+            _write_asset(root, entry['file'], data)
+            after += len(data)
+
+            if extension in COMPRESSIBLE_EXTENSIONS:
+                # Pre-compressed copies for the asset() view to pick from
+                compressed = {'.gz': gzip.compress(data, 9, mtime=0)}
+                if brotli is not None:
+                    compressed['.br'] = brotli.compress(data, quality=11)
+                for suffix, packed in compressed.items():
+                    if len(packed) < len(data):
+                        _write_asset(root, entry['file'] + suffix, packed)
+            manifest[path] = entry
+
+    _write_asset(root, 'manifest.json', json.dumps(manifest, indent=2, sort_keys=True).encode())
+    _asset_manifest['entries'] = manifest
+    return manifest, before, after
+
+
+def get_asset_manifest():
+    """
+    The build manifest, read once per process (restart after a build)
+    """
+    if 'entries' not in _asset_manifest:
+        try:
+            with open(os.path.join(current_app.static_folder, ASSET_DIR, 'manifest.json')) as f:
+                _asset_manifest['entries'] = json.load(f)
+        except FileNotFoundError:
+            _asset_manifest['entries'] = {}
+    return _asset_manifest['entries']
+
+
+@main.app_template_global()
+def asset_url(filename):
+    """
+    Drop-in for url_for('static', filename=...) that prefers the built copy
+    """
+    entry = get_asset_manifest().get(filename)
+    if entry:
+        return url_for('main.asset', filename=entry['file'])
+    return url_for('static', filename=filename)
+
+
+@main.app_template_global()
+def webp_url(filename):
+    """
+    URL of the image's WebP variant, or None before a build / without Pillow
+    """
+    entry = get_asset_manifest().get(filename)
+    if entry and entry.get('webp'):
+        return url_for('main.asset', filename=entry['webp'])
+    return None
+
+
+@main.route('/assets/<path:filename>')
+def asset(filename):
+    folder = os.path.join(current_app.static_folder, ASSET_DIR)
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        packed = safe_join(folder, filename + suffix)
+        if request.accept_encodings[encoding] and packed and os.path.isfile(packed):
+            response = send_from_directory(folder, filename + suffix, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_from_directory(folder, filename, max_age=ASSET_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@main.cli.command('build-assets')
+def build_assets_command():
+    """Write resized, WebP, compressed and fingerprinted copies of static files."""
+    manifest, before, after = build_assets(current_app.static_folder, current_app.config['ASSET_IMAGE_MAX_WIDTH'])
+    if Image is None:
+        print('[RAMMIDOC] Pillow is not installed: images copied without resizing or WebP')
+    if brotli is None:
+        print('[RAMMIDOC] brotli is not installed: CSS and JS get gzip copies only')
+    print(f'[RAMMIDOC] Built {len(manifest)} assets: {before / 1024:.0f} KiB -> {after / 1024:.0f} KiB')
+
+
+# --- RAMMIDOC: JSON API (v1) ---
+# Every response carries an ETag built from change_version counters, which
+# are bumped in the same transaction as the rows they describe. A client
+# sending that ETag back in If-None-Match gets a 304 after a single primary
+# key lookup, without the data being loaded or serialized.
+API_VERSION = 'v1'
+
+
+class ChangeVersion(db.Model):
+    """
+    A counter per cache key: 'doctors', 'availability:<did>',
+    'appointments:patient:<user id>', 'appointments:doctor:<did>'
+    """
+    __tablename__ = 'change_version'
+    key = db.Column(db.String(60), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def mark_changed(session, *keys):
+    """
+    Bumps the given keys when the session commits. Bulk writes that skip
+    ORM events call this themselves.
+    """
+    session.info.setdefault('changed_keys', set()).update(keys)
+
+
+def _version_keys(obj):
+    if isinstance(obj, Doctors):
+        return {'doctors'}
+    if isinstance(obj, (DoctorAvailability, AvailabilityOverride)):
+        return {f'availability:{obj.doctor_id}'}
+    if isinstance(obj, Appointment):
+        # Both the old and the new owner see a reassigned appointment change
+        patients = {obj.patient_id} | set(_history(obj, 'patient_id') or ())
+        doctors = {obj.doctor_id} | set(_history(obj, 'doctor_id') or ())
+        return ({f'appointments:patient:{pid}' for pid in patients if pid} |
+                {f'appointments:doctor:{did}' for did in doctors if did})
+    return set()
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_keys(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        keys = _version_keys(obj)
+        if keys:
+            mark_changed(session, *keys)
+
+
+@event.listens_for(db.session, 'before_commit')
+def bump_change_versions(session):
+    session.flush()
+    keys = session.info.pop('changed_keys', None)
+    if keys:
+        session.connection().execute(text(
+            """INSERT INTO change_version (key, version) VALUES (:key, 1)
+               ON CONFLICT (key) DO UPDATE SET version = change_version.version + 1"""
+        ), [{'key': key} for key in sorted(keys)])
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_keys(session):
+    session.info.pop('changed_keys', None)
+
+
+def versioned_json(keys, build, cache_control, extra=''):
+    """
+    Returns 304 if the client's ETag matches the current versions of keys,
+    otherwise jsonify(build()) with a fresh ETag
+    """
+    versions = dict(db.session.execute(
+        select(ChangeVersion.key, ChangeVersion.version).where(ChangeVersion.key.in_(keys))
+    ).all())
+    etag = '-'.join([API_VERSION] + [f'{key}.{versions.get(key, 0)}' for key in keys] + ([extra] if extra else []))
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    if cache_control.startswith('private'):
+        response.vary.add('Cookie')
+    return response
+
+
+def public_cache_control():
+    return f"public, max-age={current_app.config['API_MAX_AGE']}"
+
+
+@main.route('/api/v1/doctors')
+def api_doctors():
+    def build():
+        rows = db.session.execute(
+            select(Doctors.did, Doctors.doctorname, Doctors.dept).order_by(Doctors.doctorname, Doctors.did)
+        ).all()
+        return {'doctors': [{'id': did, 'name': name, 'dept': dept} for did, name, dept in rows]}
+    return versioned_json(['doctors'], build, public_cache_control())
+
+
+@main.route('/api/v1/doctors/<int:did>/availability')
+def api_doctor_availability(did):
+    """
+    Weekly hours plus the date exceptions from today on
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    def build():
+        doctor = db.get_or_404(Doctors, did, options=[lazyload(Doctors.availability_schedule)])
+        weekly = {day: {'start_time': None, 'end_time': None} for day in DAYS_OF_WEEK}
+        for day, start_time, end_time in db.session.execute(
+                select(DoctorAvailability.day_name, DoctorAvailability.start_time, DoctorAvailability.end_time)
+                .where(DoctorAvailability.doctor_id == did)):
+            weekly[day] = {'start_time': start_time, 'end_time': end_time}
+        overrides = db.session.execute(
+            select(AvailabilityOverride.date, AvailabilityOverride.start_time,
+                   AvailabilityOverride.end_time, AvailabilityOverride.reason)
+            .where(AvailabilityOverride.doctor_id == did, AvailabilityOverride.date >= today)
+            .order_by(AvailabilityOverride.date)
+        ).all()
+        return {
+            'doctor': {'id': doctor.did, 'name': doctor.doctorname, 'dept': doctor.dept},
+            'weekly': [dict(day_name=day, **hours) for day, hours in weekly.items()],
+            'overrides': [{'date': date_str, 'start_time': start_time, 'end_time': end_time, 'reason': reason}
+                          for date_str, start_time, end_time, reason in overrides],
+        }
+    # Past exceptions drop out at midnight, so the date is part of the tag
+    return versioned_json(['doctors', f'availability:{did}'], build, public_cache_control(), extra=today)
+
+
+@main.route('/api/v1/appointments')
+@login_required
+def api_appointments():
+    """
+    The logged-in patient's or doctor's appointments, oldest first
+    """
+    if current_user.usertype == 'Doctor':
+        doctor = get_current_doctor()
+        if not doctor:
+            return jsonify(appointments=[])
+        key, condition = f'appointments:doctor:{doctor.did}', Appointment.doctor_id == doctor.did
+    elif current_user.usertype == 'Patient':
+        key, condition = f'appointments:patient:{current_user.id}', Appointment.patient_id == current_user.id
+    else:
+        return jsonify(error="Only patients and doctors have appointments"), 403
+
+    def build():
+        rows = Appointment.query.filter(condition).options(*with_people()).order_by(Appointment.date, Appointment.time, Appointment.id).all()
+        return {'appointments': [{
+            'id': a.id, 'date': a.date, 'time': a.time, 'status': a.status, 'disease': a.disease,
+            'doctor': {'id': a.doctor.did, 'name': a.doctor.doctorname, 'dept': a.doctor.dept},
+            'patient': {'id': a.patient.id, 'name': a.patient.username},
+        } for a in rows]}
+    # Doctor names are embedded, so a rename changes the tag too
+    return versioned_json([key, 'doctors'], build, 'private, no-cache')
+
+
+# --- RAMMIDOC: request instrumentation ---
+# Opt-in with METRICS_ENABLED. Each request adds up its SQL, template and
+# password hashing time in g.metrics; teardown folds that into per-endpoint
+# histograms. Figures are per worker process, so scrape every worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+METRIC_HELP = {
+    'request_seconds': 'Request wall time',
+    'sql_seconds': 'Time spent executing SQL',
+    'sql_statements': 'SQL statements executed',
+    'template_seconds': 'Time spent rendering templates',
+    'hash_seconds': 'Time spent hashing or checking passwords',
+}
+STATEMENT_TEXT_LIMIT = 500
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class RequestMetrics:
+    """
+    Aggregated per-endpoint histograms and the slowest statements seen
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}     # (endpoint, status) -> count
+        self.histograms = {}   # (metric, endpoint) -> Histogram
+        self.slow_sql = {}     # endpoint -> {statement: slowest seconds}
+
+    def record(self, endpoint, status, observations, slowest, keep):
+        with self._lock:
+            self.requests[(endpoint, status)] = self.requests.get((endpoint, status), 0) + 1
+            for metric, value in observations.items():
+                buckets = STATEMENT_BUCKETS if metric == 'sql_statements' else LATENCY_BUCKETS
+                self.histograms.setdefault((metric, endpoint), Histogram(buckets)).observe(value)
+            if slowest and keep:
+                seen = self.slow_sql.setdefault(endpoint, {})
+                for seconds, statement in slowest:
+                    seen[statement] = max(seconds, seen.get(statement, 0))
+                if len(seen) > keep:
+                    self.slow_sql[endpoint] = dict(sorted(seen.items(), key=lambda item: -item[1])[:keep])
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        with self._lock:
+            lines = [
+                '# HELP rammidoc_requests_total Requests handled, by endpoint and status.',
+                '# TYPE rammidoc_requests_total counter',
+            ]
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'rammidoc_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            for metric, help_text in METRIC_HELP.items():
+                name = f'rammidoc_{metric}'
+                lines += [f'# HELP {name} {help_text} per request.', f'# TYPE {name} histogram']
+                for (hist_metric, endpoint), hist in sorted(self.histograms.items()):
+                    if hist_metric != metric:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {round(hist.sum, 6)}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {cumulative}')
+            return '\n'.join(lines) + '\n'
+
+    def slow_statements(self):
+        with self._lock:
+            return {
+                endpoint: [{'seconds': round(seconds, 6), 'statement': statement}
+                           for statement, seconds in sorted(seen.items(), key=lambda item: -item[1])]
+                for endpoint, seen in self.slow_sql.items()
+            }
+
+
+request_metrics = RequestMetrics()
+
+
+def metrics_active():
+    return has_request_context() and 'metrics' in g
+
+
+@contextmanager
+def timed(metric):
+    """
+    Adds the time spent in the block to the current request's metrics, if enabled
+    """
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        if metrics_active():
+            g.metrics[metric] += perf_counter() - started
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if metrics_active():
+        conn.info.setdefault('statement_started', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('statement_started')
+    if not started:
+        return
+    started = started.pop()
+    if not metrics_active():
+        return
+    elapsed = perf_counter() - started
+    g.metrics['sql_seconds'] += elapsed
+    g.metrics['sql_statements'] += 1
+    g.metrics['statements'].append((elapsed, statement[:STATEMENT_TEXT_LIMIT]))
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_statement_timer(context):
+    # A failed statement never reaches after_cursor_execute; drop its start so
+    # the next statement on this pooled connection is not timed against it
+    started = context.connection.info.get('statement_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+@before_render_template.connect
+def start_template_timer(sender, template, context, **extra):
+    if metrics_active():
+        g.metrics['template_started'] = perf_counter()
+
+
+@template_rendered.connect
+def stop_template_timer(sender, template, context, **extra):
+    if metrics_active() and 'template_started' in g.metrics:
+        g.metrics['template_seconds'] += perf_counter() - g.metrics.pop('template_started')
+
+
+@main.before_app_request
+def start_request_metrics():
+    if current_app.config['METRICS_ENABLED']:
+        g.metrics = {'started': perf_counter(), 'status': 500, 'statements': [],
+                     'sql_seconds': 0.0, 'sql_statements': 0, 'template_seconds': 0.0, 'hash_seconds': 0.0}
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # another thread is already being profiled
+        g.profiler = profiler
+
+
+@main.after_app_request
+def note_response_status(response):
+    if 'metrics' in g:
+        g.metrics['status'] = response.status_code
+    return response
+
+
+@main.teardown_app_request
+def finish_request_metrics(error):
+    endpoint = request.endpoint or 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        folder = os.path.join(current_app.instance_path, current_app.config['PROFILE_DIR'])
+        os.makedirs(folder, exist_ok=True)
+        # Inspect with: python -m pstats <file>
+        profiler.dump_stats(os.path.join(folder, f"{endpoint}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof"))
+
+    metrics = g.pop('metrics', None)
+    if metrics is None:
+        return
+    keep = current_app.config['METRICS_SLOW_STATEMENTS']
+    request_metrics.record(
+        endpoint, metrics['status'],
+        {'request_seconds': perf_counter() - metrics['started'],
+         'sql_seconds': metrics['sql_seconds'], 'sql_statements': metrics['sql_statements'],
+         'template_seconds': metrics['template_seconds'], 'hash_seconds': metrics['hash_seconds']},
+        sorted(metrics['statements'], reverse=True)[:keep], keep
+    )
+
+
+def metrics_allowed():
+    """
+    Admins, or a scraper presenting METRICS_TOKEN as a bearer token
+    """
+    token = current_app.config['METRICS_TOKEN']
+    header = request.headers.get('Authorization', '')
+    if token and header.startswith('Bearer ') and hmac.compare_digest(header[7:], token):
+        return True
+    return current_user.is_authenticated and current_user.usertype == 'Admin'
+
+
+def render_cache_metrics():
+    """
+    Hit, miss and size counters of this process's in-memory caches
+    """
+    caches = {'schedule': schedule_cache.stats(), 'identity': identity_cache.stats()}
+    lines = []
+    for key, name, kind, help_text in (
+            ('hits', 'rammidoc_cache_hits_total', 'counter', 'Cache lookups answered from memory.'),
+            ('misses', 'rammidoc_cache_misses_total', 'counter', 'Cache lookups that went to the database.'),
+            ('entries', 'rammidoc_cache_entries', 'gauge', 'Entries currently held.')):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{cache="{cache}"}} {stats[key]}' for cache, stats in caches.items()]
+    return '\n'.join(lines) + '\n'
+
+
+@main.route('/admin/metrics')
+def admin_metrics():
+    if not metrics_allowed():
+        abort(403)
+    return Response(request_metrics.render() + render_cache_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/admin/metrics/slow-sql')
+def admin_slow_sql():
+    if not metrics_allowed():
+        abort(403)
+    return jsonify(request_metrics.slow_statements())
+
+
+@main.cli.command('init-db')
+def init_db_command():
+    """Create tables, apply schema upgrades and make sure an admin exists."""
+    db.create_all()
+    try:
+        upgrade_schema()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    ensure_admin()
+
+
+def create_app(config_overrides=None):
+    """
+    Application factory. Config comes from DEFAULT_CONFIG, the environment
+    and config_overrides, in that order. See wsgi.py for production servers.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(load_config(config_overrides))
+    if app.config['SECRET_KEY'] == DEVELOPMENT_SECRET_KEY and not (app.debug or app.testing):
+        raise RuntimeError("SECRET_KEY is the development key from the source code. "
+                           "Set the SECRET_KEY environment variable, or run with --debug.")
+
+    if app.config['PROXY_COUNT']:
+        hops = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    db.init_app(app)
+    init_archive(app)
+    mail.init_app(app)
+    login_manager.init_app(app)
+    outbox_worker.init_app(app)
+    if app.config['OUTBOX_AUTOSTART']:
+        # Poll from boot, so mail left pending or backing off by the last run goes out
+        outbox_worker.start()
+    app.register_blueprint(main)
+    return app
+
+
+# This is the standard way to run a Flask app (development server)
 if __name__ == '__main__':
+    app = create_app({'DEBUG': True})
+
     # We must be "inside" the app to run db commands
     with app.app_context():
         db.create_all()
+        upgrade_schema()
         ensure_admin()  # This will also run your admin-creation function
     
     # This starts the web server
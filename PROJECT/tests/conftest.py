@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from main import db  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    Returns a factory for apps on fresh SQLite files in tmp_path
+    """
+    def make(name='test'):
+        app = main.create_app({
+            'TESTING': True,
+            'OUTBOX_AUTOSTART': False,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / name}.db',
+            'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        })
+        # The caches are per process; start every app from an empty view
+        main.schedule_cache.invalidate()
+        main.identity_cache.invalidate()
+        main.load_index.invalidate()
+        main._stats_cache['expires_at'] = 0
+        with app.app_context():
+            db.create_all()
+            main.upgrade_schema()
+            main.ensure_admin()
+        return app
+    return make
+
+
+def login(client, email, password):
+    return client.post('/login', data={'email': email, 'password': password}, follow_redirects=True)
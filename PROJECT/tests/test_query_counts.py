@@ -0,0 +1,86 @@
+from datetime import date, timedelta
+
+import pytest
+
+import main
+from main import db
+from conftest import login
+
+
+def seed(app, appointments):
+    """
+    A patient and a doctor with the given number of appointments. Every
+    appointment of the patient is with a different doctor and every
+    appointment of the doctor with a different patient, so a list that loads
+    people row by row shows up as extra statements.
+    """
+    with app.app_context():
+        patient = main.User(username='pat', usertype='Patient', email='p@x', password=main.hash_password('pw'))
+        doctor_user = main.User(username='Doc', usertype='Doctor', email='d@x', password=main.hash_password('pw'))
+        doctor = main.Doctors(doctorname='Doc', email='d@x', dept='Cardio')
+        db.session.add_all([patient, doctor_user, doctor])
+        db.session.flush()
+        first = date.today() + timedelta(days=1)
+        for i in range(appointments):
+            if i % 2:
+                other = main.User(username=f'pat{i}', usertype='Patient', email=f'p{i}@x', password='-')
+                db.session.add(other)
+                db.session.flush()
+                appointment = main.Appointment(patient_id=other.id, doctor_id=doctor.did)
+            else:
+                other = main.Doctors(doctorname=f'Doc{i}', email=f'd{i}@x', dept='Cardio')
+                db.session.add(other)
+                db.session.flush()
+                appointment = main.Appointment(patient_id=patient.id, doctor_id=other.did)
+            appointment.date = (first + timedelta(days=i // 8)).isoformat()
+            appointment.time = f'{9 + i % 8:02d}:00'
+            appointment.disease = 'checkup'
+            appointment.status = 'Completed' if i % 4 == 3 else 'Booked'
+            db.session.add(appointment)
+            if appointment.status == 'Completed':
+                db.session.flush()
+                db.session.add(main.Treatment(diagnosis='ok', appointment_id=appointment.id))
+        db.session.commit()
+
+
+def count_statements(app, client, url):
+    """
+    Number of SQL statements the second GET of url runs, after caches are warm
+    """
+    assert client.get(url).status_code == 200
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    main.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        assert client.get(url).status_code == 200
+    finally:
+        main.event.remove(engine, 'before_cursor_execute', record)
+    return len(statements)
+
+
+ROUTES = [
+    ('p@x', 'pw', '/bookings'),
+    ('d@x', 'pw', '/bookings'),
+    ('admin@rammidoc.local', 'Admin@123', '/admin/dashboard'),
+    ('p@x', 'pw', '/api/v1/appointments'),
+    ('admin@rammidoc.local', 'Admin@123', '/admin/patients'),
+    ('admin@rammidoc.local', 'Admin@123', '/admin/doctors'),
+]
+
+
+@pytest.mark.parametrize('email, password, url', ROUTES)
+def test_statements_do_not_grow_with_rows(make_app, email, password, url):
+    counts = []
+    for rows in (2, 40):
+        app = make_app(f'rows{rows}')
+        seed(app, rows)
+        client = app.test_client()
+        login(client, email, password)
+        counts.append(count_statements(app, client, url))
+    assert counts[0] == counts[1], f'{url} ran {counts[0]} statements for 2 rows but {counts[1]} for 40'
+    assert counts[1] <= 10
@@ -0,0 +1,50 @@
+import main
+from main import db
+
+
+def counters():
+    return {(c.scope, c.key): c.value for c in main.StatCounter.query.all() if c.value}
+
+
+def test_counters_match_a_rebuild(make_app):
+    app = make_app()
+    with app.app_context():
+        # Doctor and patient are new in the same flush as the appointments,
+        # so the hook only sees doctor_id once the flush has assigned it
+        patient = main.User(username='pat', usertype='Patient', email='p@x', password='-')
+        doctor = main.Doctors(doctorname='Doc', email='d@x', dept='Cardio')
+        other = main.Doctors(doctorname='Other', email='o@x', dept='Neuro')
+        for time in ('09:00', '10:00'):
+            db.session.add(main.Appointment(date='2030-01-07', time=time, disease='flu', status='Booked',
+                                            patient=patient, doctor=doctor))
+        db.session.add(other)
+        db.session.commit()
+
+        moved = main.Appointment.query.filter_by(time='10:00').one()
+        moved.doctor_id = other.did
+        moved.status = 'Cancelled'
+        db.session.commit()
+
+        incremental = counters()
+        main.rebuild_stats()
+        assert incremental == counters()
+        assert incremental[('dept', 'Cardio')] == 1
+        assert incremental[('dept', 'Neuro')] == 1
+
+
+def test_department_change_moves_the_count(make_app):
+    app = make_app()
+    with app.app_context():
+        patient = main.User(username='pat', usertype='Patient', email='p@x', password='-')
+        doctor = main.Doctors(doctorname='Doc', email='d@x', dept='Cardio')
+        db.session.add(main.Appointment(date='2030-01-07', time='09:00', disease='flu', status='Booked',
+                                        patient=patient, doctor=doctor))
+        db.session.commit()
+
+        doctor.dept = 'Neuro'
+        db.session.commit()
+
+        incremental = counters()
+        main.rebuild_stats()
+        assert incremental == counters()
+        assert ('dept', 'Cardio') not in incremental
@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production servers. Run from the PROJECT directory:
+
+    flask --app main init-db
+    gunicorn -w 4 -b 0.0.0.0:8000 wsgi:app
+    waitress-serve --listen=0.0.0.0:8000 wsgi:app
+"""
+from main import create_app
+
+app = create_app()